@@ -0,0 +1,162 @@
+# api_stub_server.py
+# Local stand-in for the api.atdevs.org endpoints used by client_run_api-and-lan-msging.py, for testing
+# without the real server. Run it, then start the client with MSGAPP_API_URL=http://127.0.0.1:8080.
+# It also serves the files in ./updates (with ETags and range requests) for testing delta updates with
+# MSGAPP_UPDATE_URL=http://127.0.0.1:8080/updates
+
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+DEFAULT_PORT = 8080
+MAX_WAIT = 60  # Longest a receive request may be held open
+UPDATE_DIR = "updates"  # Release files and manifests served under /updates/
+
+# In-memory server state
+users = {}  # Username -> password
+settings = {}  # Username -> settings dict
+mailboxes = {}  # Username -> list of messages, each with an increasing id
+next_message_id = 1
+state_lock = threading.Lock()
+new_message = threading.Condition(state_lock)  # Wakes long-poll receivers
+
+# Put messages in their recipients' mailboxes and wake any long-poll receivers
+def deliver(messages):
+    global next_message_id
+    with new_message:
+        for message in messages:
+            mailboxes.setdefault(message["to"], []).append(
+                {"id": next_message_id, "from": message["from"], "message": message["message"]})
+            next_message_id += 1
+        new_message.notify_all()
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real server
+
+    def send_json(self, status, body=None):
+        data = json.dumps(body if body is not None else {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    # Serve a release file, honouring If-None-Match and a single byte range (with If-Range) like a static file host
+    def send_update_file(self, name):
+        path = os.path.join(UPDATE_DIR, os.path.basename(name))
+        if not os.path.isfile(path):
+            self.send_json(404)
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        etag = '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        status = 200
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range", etag) == etag and int(match.group(1)) < len(data):
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            status, body = 206, data[start:end + 1]
+        else:
+            body = data
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path.startswith("/updates/"):
+            self.send_update_file(url.path[len("/updates/"):])
+            return
+        match = re.fullmatch(r"/publickey/([^/]+)", url.path)
+        if match:
+            with state_lock:
+                known = match.group(1) in users
+            if known:
+                self.send_json(200, {"username": match.group(1), "public_key": f"stub-key-{match.group(1)}"})
+            else:
+                self.send_json(404)
+            return
+        match = re.fullmatch(r"/message/receive/([^/]+)", url.path)
+        if match:
+            # Long-poll: return messages newer than since, waiting up to wait seconds for one to arrive
+            since = int(query.get("since", ["0"])[0])
+            wait = min(float(query.get("wait", ["0"])[0]), MAX_WAIT)
+            with new_message:
+                mailbox = mailboxes.setdefault(match.group(1), [])
+                mailbox[:] = [message for message in mailbox if message["id"] > since]  # Older ones were received
+                new_message.wait_for(lambda: mailbox, timeout=wait)
+                messages = list(mailbox)
+            cursor = messages[-1]["id"] if messages else since
+            self.send_json(200, {"messages": messages, "cursor": cursor})
+            return
+        if url.path == "/user/broadcast":
+            self.send_json(200)
+            return
+        self.send_json(404)
+
+    def do_POST(self):
+        body = self.read_json()
+        if self.path == "/user/register":
+            with state_lock:
+                if body.get("username") in users:
+                    self.send_json(409)
+                    return
+                users[body["username"]] = body.get("password")
+            self.send_json(200)
+        elif self.path == "/publickey/batch":
+            with state_lock:
+                keys = {username: {"username": username, "public_key": f"stub-key-{username}"}
+                        for username in body.get("usernames", []) if username in users}
+            self.send_json(200, keys)
+        elif self.path == "/message/send":
+            deliver([body])
+            self.send_json(200)
+        elif self.path == "/message/send/batch":
+            messages = body.get("messages", [])
+            deliver(messages)
+            self.send_json(200, {"results": [True] * len(messages)})
+        else:
+            self.send_json(404)
+
+    def do_PUT(self):
+        body = self.read_json()
+        if self.path == "/user/settings":
+            with state_lock:
+                settings.setdefault(body["username"], {})["theme"] = body.get("theme")
+            self.send_json(200)
+        else:
+            self.send_json(404)
+
+    def log_message(self, format, *args):
+        print(f"{self.address_string()} {format % args}")
+
+# Start the stub server; returns it so callers can shut it down
+def start_stub_server(port=DEFAULT_PORT):
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    print(f"API stub server listening on http://127.0.0.1:{port}")
+    ThreadingHTTPServer(("127.0.0.1", port), StubHandler).serve_forever()
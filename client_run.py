@@ -1,20 +1,94 @@
 import os
+import asyncio
 import socket
 import subprocess
 import tkinter as tk
-from tkinter import scrolledtext, simpledialog, messagebox, ttk
-from threading import Thread
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from tkinter import scrolledtext, simpledialog, messagebox, filedialog, ttk
+from threading import Thread, Event, Lock
+from collections import deque, OrderedDict
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.exceptions import InvalidTag, InvalidSignature
+from cryptography.hazmat.primitives.asymmetric import rsa, ed25519, x25519, padding
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 from cryptography.hazmat.backends import default_backend
 import base64
+import hashlib
 import json
+import mmap
+import random
+import sqlite3
+import struct
 import time
+import zlib
 
 BROADCAST_PORT = 5555
 BUFFER_SIZE = 1024
+DISCOVERY_MODE = "multicast"  # Or "broadcast"; can be overridden in the settings file
+MULTICAST_GROUP = "239.255.55.55"  # Site-local group the discovery beacons are sent to
+BEACON_MIN_INTERVAL = 2  # Seconds between beacons right after starting or our address changing
+BEACON_MAX_INTERVAL = 60  # Beacon interval backs off to this
+BEACON_JITTER = 0.2  # Beacon intervals are randomized by this fraction to avoid synchronized storms
+QUERY_RESPONSE_DELAY = 1.0  # Max random delay before answering a discovery query
+PEER_TTL = 3 * BEACON_MAX_INTERVAL  # Seconds without a beacon before a peer is considered gone
+CAPABILITIES = ["stream", "aead", "zlib"]  # Features we advertise in discovery beacons
+SEND_BATCH_SIZE = 64  # Max datagrams written per event loop turn
+MAX_DATAGRAM_SIZE = BUFFER_SIZE  # Larger payloads go over the TCP stream channel instead of UDP
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Largest stream frame we accept from a peer
+STREAM_CONNECT_TIMEOUT = 5  # Seconds to wait for a peer to accept a stream connection
+FRAME_HEADER = struct.Struct('!I')  # 4-byte big-endian length prefix for stream frames
+FRAME_VERSION = 1  # First byte of an encrypted message frame
+GROUP_FRAME_VERSION = 2  # First byte of an encrypted group message frame
+FILE_FRAME_VERSION = 3  # First byte of an encrypted file chunk frame
+FILE_CHUNK_INDEX = struct.Struct('!Q')  # Chunk number in a file chunk frame header
+FILE_CHUNK_SIZE = 256 * 1024  # Bytes of file data per chunk
+MAX_FILE_SIZE = 16 * 1024 ** 3  # Largest file we accept an offer for; keeps its chunk hash list well inside a frame
+FILE_WINDOW = 64  # Chunks requested from the sender at a time; bounds memory on both ends
+FILE_STALL_TIMEOUT = 10  # Seconds without a chunk before missing chunks are requested again
+FILE_STATE_SAVE_INTERVAL = 1  # Seconds between saves of a download's progress, for resuming
+DOWNLOAD_DIR = "downloads"  # Received files, and partial downloads with their progress files
+OUTGOING_FILES_FILE = "outgoing_files.json"  # Files we've offered that haven't been received yet, so they survive a restart
+UPDATE_CACHE_DIR = "update_cache"  # Verified update files kept by client_update.py, named by hash, served to LAN peers
+NONCE_SIZE = 12  # 96-bit AEAD nonce
+TAG_SIZE = 16  # AEAD authentication tag appended to the ciphertext
+COMPRESS_MIN_SIZE = 64  # Plaintexts shorter than this are never worth compressing
+COMPRESSION_LEVEL = 6
+COMPRESSED_MARKER = b'\x01'  # First byte of a compressed plaintext; uncompressed ones are JSON and start with '{'
+# Preset dictionary for compressed messages, most common strings last. Peers must share it exactly, so
+# changing it means advertising a new capability name instead of "zlib"
+CHAT_DICTIONARY = (
+    b"Traceback (most recent call last):\n  File \"line  Error: Exception import def return self. None True False "
+    b"https://www. .com .org .py .txt .log .json  INFO WARNING ERROR DEBUG  thanks please could you can we "
+    b"would should will have this that with what when where there here the and for you are not but just "
+    b"ok yes no lol haha sorry meeting today tomorrow message file \\n\\n    \", \"members\": [\"\", \"group\": \""
+    b"{\"ack\": \"{\"id\": \"\", \"text\": \""
+)
+SESSION_CIPHER = "aes-gcm"  # Or "chacha20-poly1305" for machines without AES hardware support
+SESSION_CACHE_SIZE = 256  # Max live sessions kept; the least recently used is evicted first
+SESSION_TTL = 60 * 60  # Seconds before a session is dropped and renegotiated
+REKEY_AFTER_MESSAGES = 10000  # Messages encrypted under one session key before we rekey
+HANDSHAKE_TIMEOUT = 5  # Seconds before an unanswered handshake is resent
+AUTH_FAILURE_LIMIT = 3  # Frames from a peer that fail to decrypt before the session is renegotiated
+RECEIVE_WORKERS = 4  # Threads decoding and decrypting incoming payloads
+RECEIVE_PUMP_INTERVAL = 50  # Milliseconds between moving received messages into the chat window
+RECEIVE_BATCH_SIZE = 200  # Max received messages inserted per pump
+RENDER_INTERVAL = 16  # Milliseconds pending chat lines are held so they can be inserted together
+MAX_CHAT_LINES = 5000  # Lines kept in the chat window; can be overridden in the settings file
 THEME_FILE = "theme_settings.json"  # File to store theme settings
+HISTORY_FILE = "chat_history.db"  # SQLite message history
+HISTORY_PAGE_SIZE = 100  # Messages loaded at startup and per scrollback page
+SEARCH_LIMIT = 50  # Max hits shown for a history search
+SEARCH_CONTEXT = 5  # Messages shown either side of a search hit
+OUTBOX_WINDOW = 8  # Unacknowledged messages in flight per recipient
+RETRY_INITIAL = 1  # Seconds before the first retransmit of an unacknowledged message
+RETRY_MAX = 30  # Retransmit backoff stops doubling at this many seconds
+RECENT_IDS = 1024  # Message ids remembered per sender to drop retransmitted duplicates
+KEYSTORE_FILE = "identity_key.pem"  # Private identity key, readable only by the user
+PUBLIC_KEY_FILE = "identity_key.pub"  # Public half of the identity key, safe to hand out
+KEYSTORE_PASSPHRASE_ENV = "MSGAPP_KEY_PASSPHRASE"  # If set, the identity key is stored encrypted with this passphrase
+IDENTITY_KEY_TYPE = "ed25519"  # Or "rsa" (much slower to sign with); can be overridden in the settings file
 
 # Helper function to get the local IP address
 def get_local_ip():
@@ -27,32 +101,360 @@ def get_local_ip():
     finally:
         s.close()
 
-# Function to broadcast the username on the network
-def broadcast_username(username):
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+# Asyncio protocol that hands every datagram on the shared socket to the transport engine
+class LanProtocol(asyncio.DatagramProtocol):
+    def __init__(self, engine):
+        self.engine = engine
 
-    broadcast_message = json.dumps({"username": username})
-    while True:
-        udp_socket.sendto(broadcast_message.encode(), ('<broadcast>', BROADCAST_PORT))
-        time.sleep(5)  # Broadcast every 5 seconds
+    def connection_made(self, transport):
+        self.engine.transport = transport
 
-# Function to listen for other clients on the network
-def listen_for_broadcasts(known_users, local_username):
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    udp_socket.bind(('', BROADCAST_PORT))
+    def datagram_received(self, data, addr):
+        self.engine.handle_payload(data, addr)
 
-    while True:
-        message, addr = udp_socket.recvfrom(BUFFER_SIZE)
+    def error_received(self, exc):
+        print(f"LAN transport error: {exc}")
+
+# Length-prefixed framing over a persistent TCP connection to a peer
+class StreamConnection(asyncio.Protocol):
+    def __init__(self, engine, outbound=False):
+        self.engine = engine
+        self.outbound = outbound  # True if we opened it; only those are pooled for sending to the peer
+        self.transport = None
+        self.peer = None
+        self.buffer = bytearray()
+        self.writable = asyncio.Event()  # Cleared while the transport's write buffer is over its high-water mark
+        self.writable.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+        self.engine.add_stream(self)
+
+    def write_frame(self, payload):
+        self.transport.writelines((FRAME_HEADER.pack(len(payload)), payload))
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    # Wait until the write buffer has drained below its low-water mark, for senders that pace themselves
+    async def drain(self):
+        await self.writable.wait()
+        if self.transport.is_closing():
+            raise ConnectionError(f"Stream to {self.peer[0]} closed")
+
+    def data_received(self, data):
+        self.buffer += data
+        while len(self.buffer) >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self.buffer)
+            if length > MAX_FRAME_SIZE:
+                print(f"Dropping stream from {self.peer[0]}: frame of {length} bytes is too large")
+                self.transport.close()
+                return
+            end = FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            payload = bytes(self.buffer[FRAME_HEADER.size:end])
+            del self.buffer[:end]
+            self.engine.handle_payload(payload, self.peer)
+
+    def connection_lost(self, exc):
+        self.writable.set()  # Wake anyone in drain so they see the connection is gone
+        self.engine.remove_stream(self)
+
+# Directory of peers discovered on the LAN. Tracks address, capabilities and last-seen time per peer,
+# expires peers that stop beaconing using a timer wheel with one slot per second, and reports joins,
+# address changes and leaves to on_change. A repeat beacon only refreshes the last-seen time
+class PeerDirectory:
+    def __init__(self, ttl=PEER_TTL, on_change=None):
+        self.ttl = ttl
+        self.on_change = on_change  # Called with (event, username, address); event is "join", "update" or "leave"
+        self.peers = {}  # Username -> [address, capabilities, last seen]
+        self.lock = Lock()
+        self.wheel = [set() for _ in range(ttl + 1)]
+        self.cursor = 0
+
+    def seen(self, username, address, capabilities=()):
+        capabilities = frozenset(capabilities)
+        now = time.monotonic()
+        with self.lock:
+            peer = self.peers.get(username)
+            if peer and peer[0] == address and peer[1] == capabilities:
+                peer[2] = now
+                return
+            self.peers[username] = [address, capabilities, now]
+            if peer is None:
+                self.wheel[(self.cursor + self.ttl) % len(self.wheel)].add(username)
+        if self.on_change:
+            self.on_change("update" if peer else "join", username, address)
+
+    def remove(self, username):
+        with self.lock:
+            peer = self.peers.pop(username, None)
+        if peer and self.on_change:
+            self.on_change("leave", username, peer[0])
+
+    # Advance the wheel one slot (call once a second). Peers in the slot are expired if they've been
+    # silent for the full TTL, otherwise rescheduled for when they would be
+    def tick(self):
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            self.cursor = (self.cursor + 1) % len(self.wheel)
+            slot = self.wheel[self.cursor]
+            self.wheel[self.cursor] = set()
+            for username in slot:
+                peer = self.peers.get(username)
+                if peer is None:
+                    continue
+                remaining = self.ttl - (now - peer[2])
+                if remaining <= 0:
+                    del self.peers[username]
+                    expired.append((username, peer[0]))
+                else:
+                    self.wheel[(self.cursor + max(1, int(remaining + 0.5))) % len(self.wheel)].add(username)
+        if self.on_change:
+            for username, address in expired:
+                self.on_change("leave", username, address)
+
+    def capabilities(self, username):
+        peer = self.peers.get(username)
+        return peer[1] if peer else frozenset()
+
+    def get(self, username, default=None):
+        peer = self.peers.get(username)
+        return peer[0] if peer else default
+
+    def __getitem__(self, username):
+        return self.peers[username][0]
+
+    def __contains__(self, username):
+        return username in self.peers
+
+# Long-lived LAN transport: one bound UDP socket on BROADCAST_PORT for discovery, sending and receiving,
+# plus a TCP stream channel on the same port for large payloads, driven by a single asyncio loop on a
+# background thread
+class LanTransport:
+    def __init__(self, username, known_users, on_payload=None, discovery_mode=DISCOVERY_MODE):
+        self.username = username
+        self.known_users = known_users
+        self.discovery_mode = discovery_mode
+        self.discovery_addr = ('<broadcast>', BROADCAST_PORT)
+        self.local_ip = None  # Our address when the last beacon went out
+        self.on_payload = on_payload  # Called with (data, addr) for anything that isn't a discovery beacon
+        self.loop = asyncio.new_event_loop()
+        self.transport = None
+        self.ready = Event()
+        self.send_queue = deque()
+        self.send_lock = Lock()
+        self.flush_pending = False
+        self.beacon_task = None
+        self.expire_task = None
+        self.stream_server = None
+        self.streams = {}  # Pooled stream connections keyed by peer IP; only ones we opened
+        self.connections = {}  # Every open stream connection, inbound or outbound, keyed by (IP, port)
+        self.connecting = {}  # Frames waiting on a stream connection that is still being opened
+
+    # Start the event loop thread and wait until the socket is bound
+    def start(self):
+        Thread(target=self.run, daemon=True).start()
+        self.ready.wait()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
         try:
-            data = json.loads(message.decode())
-            username = data.get("username")
-            if username and username != local_username:
-                known_users[username] = addr[0]
-                print(f"Discovered user {username} at {addr[0]}")
+            self.loop.run_until_complete(self.open())
         except Exception as e:
-            print(f"Error decoding broadcast: {e}")
+            print(f"Error starting LAN transport: {e}")
+        finally:
+            self.ready.set()
+        self.loop.run_forever()
+
+    async def open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.bind(('', BROADCAST_PORT))
+        if self.discovery_mode == "multicast":
+            try:
+                local_ip = socket.inet_aton(get_local_ip())
+                membership = struct.pack('4s4s', socket.inet_aton(MULTICAST_GROUP), local_ip)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, local_ip)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+                self.discovery_addr = (MULTICAST_GROUP, BROADCAST_PORT)
+            except OSError as e:
+                print(f"Multicast unavailable, falling back to broadcast: {e}")
+        await self.loop.create_datagram_endpoint(lambda: LanProtocol(self), sock=sock)
+        self.stream_server = await self.loop.create_server(
+            lambda: StreamConnection(self), '', BROADCAST_PORT, reuse_address=True)
+        self.beacon_task = self.loop.create_task(self.beacon_loop())
+        self.expire_task = self.loop.create_task(self.expire_loop())
+        self.flush()  # Anything queued before the socket was ready
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.close)
+
+    def close(self):
+        if self.transport:
+            self.transport.sendto(self.beacon(leave=True), self.discovery_addr)  # Let peers drop us straight away
+        if self.beacon_task:
+            self.beacon_task.cancel()
+            self.expire_task.cancel()
+        if self.transport:
+            self.transport.close()
+        if self.stream_server:
+            self.stream_server.close()
+        for conn in list(self.connections.values()):
+            conn.transport.close()
+        self.loop.call_soon(self.loop.stop)  # Let the cancelled tasks unwind first
+
+    def beacon(self, query=False, leave=False):
+        beacon = {"username": self.username, "caps": CAPABILITIES}
+        if query:
+            beacon["query"] = True
+        if leave:
+            beacon["leave"] = True
+        return json.dumps(beacon).encode()
+
+    # Announce the username on the network. The first beacon is a query so peers answer straight away;
+    # after that the interval doubles up to BEACON_MAX_INTERVAL. Other peers joining or leaving doesn't
+    # reset it (newcomers get answers to their query), or every join would set off a burst of beacons from
+    # the whole LAN; only a change of our own address does, starting again with a query
+    async def beacon_loop(self):
+        self.local_ip = get_local_ip()
+        self.send(self.beacon(query=True), self.discovery_addr)
+        interval = BEACON_MIN_INTERVAL
+        while True:
+            await asyncio.sleep(interval * random.uniform(1 - BEACON_JITTER, 1 + BEACON_JITTER))
+            local_ip = get_local_ip()
+            if local_ip != self.local_ip:
+                self.local_ip = local_ip
+                self.send(self.beacon(query=True), self.discovery_addr)
+                interval = BEACON_MIN_INTERVAL
+            else:
+                self.send(self.beacon(), self.discovery_addr)
+                interval = min(interval * 2, BEACON_MAX_INTERVAL)
+
+    # Drive the peer directory's expiry wheel
+    async def expire_loop(self):
+        while True:
+            await asyncio.sleep(1)
+            self.known_users.tick()
+
+    # Queue a payload for sending; safe to call from any thread. Payloads for a client (on BROADCAST_PORT)
+    # that are too large for a single datagram, or for a peer we already hold a stream to, go over the
+    # stream channel; replies to anything else, like an updater's query from its own port, go back by UDP
+    def send(self, payload, addr):
+        if addr[1] == BROADCAST_PORT and (len(payload) > MAX_DATAGRAM_SIZE or addr[0] in self.streams):
+            self.loop.call_soon_threadsafe(self.send_stream, payload, addr[0])
+            return
+        self.send_queue.append((payload, addr))
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        with self.send_lock:
+            if self.flush_pending:
+                return
+            self.flush_pending = True
+        self.loop.call_soon_threadsafe(self.flush)
+
+    # Drain the send queue in batches so a burst of sends doesn't starve the receive side
+    def flush(self):
+        with self.send_lock:
+            self.flush_pending = False
+        if self.transport is None:
+            return
+        for _ in range(min(len(self.send_queue), SEND_BATCH_SIZE)):
+            payload, addr = self.send_queue.popleft()
+            try:
+                self.transport.sendto(payload, addr)
+            except Exception as e:
+                print(f"Error sending to {addr[0]}: {e}")
+        if self.send_queue:
+            self.schedule_flush()
+
+    # Write a frame to the pooled stream for a peer, opening the connection if needed
+    def send_stream(self, payload, ip):
+        conn = self.streams.get(ip)
+        if conn:
+            conn.write_frame(payload)
+        elif ip in self.connecting:
+            self.connecting[ip].append(payload)
+        else:
+            self.connecting[ip] = [payload]
+            self.loop.create_task(self.connect_stream(ip))
+
+    async def connect_stream(self, ip):
+        try:
+            await asyncio.wait_for(
+                self.loop.create_connection(lambda: StreamConnection(self, outbound=True), ip, BROADCAST_PORT),
+                STREAM_CONNECT_TIMEOUT)
+        except Exception as e:
+            print(f"Error opening stream to {ip}: {e}")
+        pending = self.connecting.pop(ip, [])
+        conn = self.streams.get(ip)
+        if conn:
+            for payload in pending:
+                conn.write_frame(payload)
+        elif pending:
+            print(f"Dropped {len(pending)} message(s) for {ip}")
+
+    # The pooled stream to a peer, opening it if needed; for senders that pace themselves with drain().
+    # Must be awaited on the transport loop
+    async def open_stream(self, ip):
+        if ip not in self.streams:
+            await asyncio.wait_for(
+                self.loop.create_connection(lambda: StreamConnection(self, outbound=True), ip, BROADCAST_PORT),
+                STREAM_CONNECT_TIMEOUT)
+        return self.streams[ip]
+
+    # Connections peers open to us only carry what they send, and might be an updater's rather than a
+    # client's, so they're never used for sending to that peer; only serve_update answers on one
+    def add_stream(self, conn):
+        self.connections[conn.peer] = conn
+        if conn.outbound:
+            self.streams.setdefault(conn.peer[0], conn)
+
+    def remove_stream(self, conn):
+        if self.connections.get(conn.peer) is conn:
+            del self.connections[conn.peer]
+        if self.streams.get(conn.peer[0]) is conn:
+            del self.streams[conn.peer[0]]
+
+    # Drop the pooled stream to a peer that has gone away; safe to call from any thread
+    def close_stream(self, ip):
+        def close():
+            conn = self.streams.pop(ip, None)
+            if conn:
+                conn.transport.close()
+        self.loop.call_soon_threadsafe(close)
+
+    # Handle anything that arrives on the shared socket; binary frames skip JSON decoding entirely
+    def handle_payload(self, data, addr):
+        username = None
+        if data[:1] == b'{':
+            try:
+                beacon = json.loads(data.decode())
+                username = beacon.get("username")
+            except Exception:
+                pass
+        if username is None:
+            if self.on_payload:
+                self.on_payload(data, addr)
+            return
+        if username == self.username:
+            return
+        if beacon.get("leave"):
+            self.known_users.remove(username)
+            return
+        self.known_users.seen(username, addr[0], beacon.get("caps", ()))
+        if beacon.get("query"):
+            # Answer the newcomer directly, after a random delay so the whole LAN doesn't reply at once
+            self.loop.call_later(random.uniform(0, QUERY_RESPONSE_DELAY), self.send, self.beacon(), addr)
 
 # Generate RSA key pair
 def generate_rsa_key_pair():
@@ -64,70 +466,639 @@ def generate_rsa_key_pair():
     public_key = private_key.public_key()
     return private_key, public_key
 
-# Encrypt a message using a public key (RSA)
-def encrypt_message_rsa(public_key, message):
-    encrypted = public_key.encrypt(
-        message.encode(),
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
+# Generate a new identity private key of the given type
+def generate_identity_key(key_type):
+    if key_type == "ed25519":
+        return ed25519.Ed25519PrivateKey.generate()
+    return generate_rsa_key_pair()[0]
+
+# Sign data with an identity key, raising TypeError for key types that can't sign
+def sign_with_identity(private_key, data):
+    if isinstance(private_key, rsa.RSAPrivateKey):
+        return private_key.sign(data, padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+                                hashes.SHA256())
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        return private_key.sign(data)
+    raise TypeError("Identity key can't sign")
+
+# Check a signature made by sign_with_identity, raising InvalidSignature if it doesn't match
+def verify_identity_signature(public_key, signature, data):
+    if isinstance(public_key, rsa.RSAPublicKey):
+        public_key.verify(signature, data, padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+                          hashes.SHA256())
+    elif isinstance(public_key, ed25519.Ed25519PublicKey):
+        public_key.verify(signature, data)
+    else:
+        raise InvalidSignature()
+
+# Passphrase protecting the keystore on disk, or None to store the key unencrypted. There is no default:
+# anything derived from what peers can see (like the username) would protect nothing
+def get_keystore_passphrase():
+    passphrase = os.environ.get(KEYSTORE_PASSPHRASE_ENV)
+    return passphrase.encode() if passphrase else None
+
+# Make a file readable and writable only by the current user: mode 0600, or on Windows (where the mode
+# bits don't cover reading) an ACL granting only the user access, set with icacls. Returns False if that failed
+def restrict_to_owner(path):
+    if os.name != "nt":
+        os.chmod(path, 0o600)
+        return True
+    user = os.environ.get("USERNAME")
+    if os.environ.get("USERDOMAIN") and user:
+        user = f"{os.environ['USERDOMAIN']}\\{user}"
+    try:
+        subprocess.run(["icacls", path, "/inheritance:r", "/grant:r", f"{user}:F"],
+                       check=True, capture_output=True)
+        return True
+    except (OSError, TypeError, subprocess.CalledProcessError) as e:
+        print(f"Error restricting access to {path}: {e}")
+        return False
+
+# On-disk identity keystore, loaded or generated on first run on a background thread so the window can
+# come up straight away. The private key is a PEM file only the user can read (see restrict_to_owner),
+# encrypted only if a passphrase is given. A key that can't be decrypted is left untouched and reported
+# through error
+class IdentityKeyStore:
+    def __init__(self, passphrase, key_type=IDENTITY_KEY_TYPE, path=KEYSTORE_FILE, public_path=PUBLIC_KEY_FILE):
+        self.passphrase = passphrase
+        self.key_type = key_type
+        self.path = path
+        self.public_path = public_path
+        self.private_key = None
+        self.public_key = None
+        self.error = None  # Why the key couldn't be loaded, once ready is set
+        self.ready = Event()
+        self.lock = Lock()  # Guards waiting against ready being set
+        self.waiting = []  # Callbacks to run once the key has loaded
+
+    def load_async(self):
+        Thread(target=self.load, daemon=True).start()
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    pem = f.read()
+                encrypted = b"ENCRYPTED" in pem.split(b"\n", 1)[0]
+                if encrypted and not self.passphrase:
+                    self.error = (f"{self.path} is encrypted. Set {KEYSTORE_PASSPHRASE_ENV} to its passphrase, "
+                                  f"or delete it to create a new identity.")
+                    return
+                try:
+                    self.private_key = serialization.load_pem_private_key(pem, password=self.passphrase if encrypted else None)
+                except ValueError:
+                    self.error = (f"{self.path} could not be decrypted with the passphrase in {KEYSTORE_PASSPHRASE_ENV}. "
+                                  f"Set it to the passphrase the key was saved with, or delete the file to create a new identity.")
+                    return
+                if self.passphrase and not encrypted:
+                    self.save()  # A passphrase was set since the key was stored
+                if isinstance(self.private_key, x25519.X25519PrivateKey):
+                    # Identity keys sign handshakes now, which an X25519 key can't do
+                    print("Replacing x25519 identity key with an ed25519 one...")
+                    self.private_key = generate_identity_key("ed25519")
+                    self.save()
+            else:
+                print(f"Generating new {self.key_type} identity key...")
+                self.private_key = generate_identity_key(self.key_type)
+                self.save()
+            self.public_key = self.private_key.public_key()
+        except Exception as e:
+            self.error = f"Error loading identity key: {e}"
+        finally:
+            if self.error:
+                print(self.error)
+            with self.lock:
+                self.ready.set()
+                waiting, self.waiting = self.waiting, []
+            for callback in waiting:
+                callback()
+
+    def save(self):
+        private_pem = self.private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=(serialization.BestAvailableEncryption(self.passphrase) if self.passphrase
+                                  else serialization.NoEncryption())
         )
-    )
-    return base64.b64encode(encrypted).decode()
-
-# Decrypt a message using a private key (RSA)
-def decrypt_message_rsa(private_key, encrypted_message):
-    encrypted_message = base64.b64decode(encrypted_message)
-    decrypted = private_key.decrypt(
-        encrypted_message,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
+        public_pem = self.private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
         )
-    )
-    return decrypted.decode()
+        tmp_path = self.path + ".tmp"
+        os.close(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600))
+        if not restrict_to_owner(tmp_path) and not self.passphrase:
+            print(f"Warning: {self.path} may be readable by other users of this computer; "
+                  f"set {KEYSTORE_PASSPHRASE_ENV} to store it encrypted")
+        with open(tmp_path, 'wb') as f:  # Truncating keeps the permissions just set
+            f.write(private_pem)
+        os.replace(tmp_path, self.path)
+        with open(self.public_path, 'wb') as f:
+            f.write(public_pem)
+
+    # Call callback once the key has loaded (straight away if it has), on the loading thread if it hasn't
+    def when_ready(self, callback):
+        with self.lock:
+            if not self.ready.is_set():
+                self.waiting.append(callback)
+                return
+        callback()
+
+    # Block until the key is available and return (private_key, public_key)
+    def get(self, timeout=None):
+        self.ready.wait(timeout)
+        return self.private_key, self.public_key
 
 # Generate AES key for symmetric encryption
 def generate_aes_key():
     return os.urandom(32)  # 256-bit key
 
-# Encrypt a message using AES
-def encrypt_message_aes(aes_key, message):
-    iv = os.urandom(16)  # 128-bit IV
-    cipher = Cipher(algorithms.AES(aes_key), modes.CFB(iv), backend=default_backend())
-    encryptor = cipher.encryptor()
-    ciphertext = encryptor.update(message.encode()) + encryptor.finalize()
-    return base64.b64encode(iv + ciphertext).decode()
-
-# Decrypt a message using AES
-def decrypt_message_aes(aes_key, encrypted_message):
-    encrypted_message = base64.b64decode(encrypted_message)
-    iv = encrypted_message[:16]
-    ciphertext = encrypted_message[16:]
-    cipher = Cipher(algorithms.AES(aes_key), modes.CFB(iv), backend=default_backend())
-    decryptor = cipher.decryptor()
-    return decryptor.update(ciphertext) + decryptor.finalize()
-
-# Share public keys and establish session key (E2EE)
+# Per-contact session crypto: the AEAD object holds the prepared key, so each message only pays
+# for a fresh nonce and the cipher work itself
+class SessionCipher:
+    def __init__(self, aes_key, cipher_name=SESSION_CIPHER):
+        self.aes_key = aes_key
+        self.aead = ChaCha20Poly1305(aes_key) if cipher_name == "chacha20-poly1305" else AESGCM(aes_key)
+        self.created = time.monotonic()
+        self.messages = 0  # Messages encrypted so far, used to decide when to rekey
+
+    def encrypt_with_nonce(self, nonce, sender, message, compress=False):
+        return self.seal(nonce, pack_frame_header(sender), message, compress)
+
+    # Encrypt a message under a frame header built by the caller; the header is authenticated too.
+    # Set compress only for peers that advertise "zlib"
+    def seal(self, nonce, header, message, compress=False):
+        plaintext = message.encode()
+        if compress:
+            plaintext = compress_payload(plaintext)
+        return self.seal_bytes(nonce, header, plaintext)
+
+    # Encrypt raw bytes such as a file chunk as they are, with no compression marker
+    def seal_bytes(self, nonce, header, plaintext):
+        self.messages += 1
+        return header + nonce + self.aead.encrypt(nonce, plaintext, header)
+
+    # Build a binary frame for a message; the frame header is authenticated along with the ciphertext
+    def encrypt(self, sender, message, compress=False):
+        return self.encrypt_with_nonce(os.urandom(NONCE_SIZE), sender, message, compress)
+
+    # Decrypt a frame, raising InvalidTag if it was corrupted or tampered with
+    def decrypt(self, frame):
+        sender, header, nonce, ciphertext = unpack_frame(frame)
+        return self.open(header, nonce, ciphertext)
+
+    def open(self, header, nonce, ciphertext):
+        return decompress_payload(self.open_bytes(header, nonce, ciphertext)).decode()
+
+    def open_bytes(self, header, nonce, ciphertext):
+        return self.aead.decrypt(nonce, ciphertext, header)
+
+    # Encrypt a burst of messages, drawing all the nonces from a single urandom call
+    def encrypt_many(self, sender, messages, compress=False):
+        nonces = os.urandom(NONCE_SIZE * len(messages))
+        return [self.encrypt_with_nonce(nonces[i * NONCE_SIZE:(i + 1) * NONCE_SIZE], sender, message, compress)
+                for i, message in enumerate(messages)]
+
+    def decrypt_many(self, frames):
+        return [self.decrypt(frame) for frame in frames]
+
+# Compress a plaintext with the shared chat dictionary (raw deflate, so no zlib header or checksum; the
+# AEAD tag already covers integrity), keeping the original if compressing doesn't make it smaller
+def compress_payload(plaintext):
+    if len(plaintext) < COMPRESS_MIN_SIZE:
+        return plaintext
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15, zdict=CHAT_DICTIONARY)
+    compressed = COMPRESSED_MARKER + compressor.compress(plaintext) + compressor.flush()
+    return compressed if len(compressed) < len(plaintext) else plaintext
+
+# Undo compress_payload; refuses to inflate past MAX_FRAME_SIZE so a peer can't send a decompression bomb
+def decompress_payload(plaintext):
+    if plaintext[:1] != COMPRESSED_MARKER:
+        return plaintext
+    decompressor = zlib.decompressobj(-15, zdict=CHAT_DICTIONARY)
+    plaintext = decompressor.decompress(plaintext[1:], MAX_FRAME_SIZE)
+    if decompressor.unconsumed_tail or not decompressor.eof:  # Input left over, or output still held back
+        raise ValueError("Compressed message is too large")
+    return plaintext
+
+# Frame header: version byte, sender id length, sender id
+def pack_frame_header(sender):
+    sender = sender.encode()
+    if len(sender) > 255:
+        raise ValueError("Sender id is too long for a frame header")
+    return bytes((FRAME_VERSION, len(sender))) + sender
+
+# Split a frame into (sender, header, nonce, ciphertext), raising ValueError if it's malformed
+def unpack_frame(frame):
+    if len(frame) < 2 or frame[0] != FRAME_VERSION:
+        raise ValueError("Not a message frame")
+    header_len = 2 + frame[1]
+    if len(frame) < header_len + NONCE_SIZE + TAG_SIZE:
+        raise ValueError("Truncated message frame")
+    header = frame[:header_len]
+    nonce = frame[header_len:header_len + NONCE_SIZE]
+    return header[2:].decode(), header, nonce, frame[header_len + NONCE_SIZE:]
+
+# Group frame header: version byte, group name length, group name, sender id length, sender id
+def pack_group_header(group, sender):
+    group, sender = group.encode(), sender.encode()
+    if len(group) > 255 or len(sender) > 255:
+        raise ValueError("Group name or sender id is too long for a frame header")
+    return bytes((GROUP_FRAME_VERSION, len(group))) + group + bytes((len(sender),)) + sender
+
+# Split a group frame into (group, sender, header, nonce, ciphertext), raising ValueError if it's malformed
+def unpack_group_frame(frame):
+    if len(frame) < 3 or frame[0] != GROUP_FRAME_VERSION:
+        raise ValueError("Not a group message frame")
+    sender_at = 2 + frame[1]
+    if len(frame) < sender_at + 1:
+        raise ValueError("Truncated group message frame")
+    header_len = sender_at + 1 + frame[sender_at]
+    if len(frame) < header_len + NONCE_SIZE + TAG_SIZE:
+        raise ValueError("Truncated group message frame")
+    header = frame[:header_len]
+    nonce = frame[header_len:header_len + NONCE_SIZE]
+    return (header[2:sender_at].decode(), header[sender_at + 1:].decode(), header, nonce,
+            frame[header_len + NONCE_SIZE:])
+
+# File chunk frame header: version byte, sender id length, sender id, 16-byte transfer id, chunk number
+def pack_file_header(sender, transfer_id, index):
+    sender = sender.encode()
+    if len(sender) > 255:
+        raise ValueError("Sender id is too long for a frame header")
+    return bytes((FILE_FRAME_VERSION, len(sender))) + sender + bytes.fromhex(transfer_id) + FILE_CHUNK_INDEX.pack(index)
+
+# Split a file chunk frame into (sender, transfer id, chunk number, header, nonce, ciphertext), raising
+# ValueError if it's malformed
+def unpack_file_frame(frame):
+    if len(frame) < 2 or frame[0] != FILE_FRAME_VERSION:
+        raise ValueError("Not a file chunk frame")
+    header_len = 2 + frame[1] + 16 + FILE_CHUNK_INDEX.size
+    if len(frame) < header_len + NONCE_SIZE + TAG_SIZE:
+        raise ValueError("Truncated file chunk frame")
+    header = frame[:header_len]
+    sender_end = 2 + frame[1]
+    (index,) = FILE_CHUNK_INDEX.unpack_from(header, sender_end + 16)
+    return (header[2:sender_end].decode(), header[sender_end:sender_end + 16].hex(), index, header,
+            frame[header_len:header_len + NONCE_SIZE], frame[header_len + NONCE_SIZE:])
+
+# Raw bytes of an X25519 public key, as sent in handshakes
+def public_key_bytes(public_key):
+    return public_key.public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+
+# Derive a session key from our ephemeral X25519 key and the peer's (ECDH + HKDF). Both public keys
+# go into the HKDF info in a fixed order so each side derives the same key
 def establish_session_key(my_private_key, other_public_key):
-    aes_key = generate_aes_key()
-    encrypted_aes_key = encrypt_message_rsa(other_public_key, base64.b64encode(aes_key).decode())
-    return aes_key, encrypted_aes_key
+    shared_secret = my_private_key.exchange(other_public_key)
+    public_keys = sorted((public_key_bytes(my_private_key.public_key()), public_key_bytes(other_public_key)))
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"msgapp session key" + b"".join(public_keys)
+    ).derive(shared_secret)
+
+# Bounded session cache keyed by peer, with LRU eviction, a TTL and a per-session message budget
+# after which the session is dropped so the next send renegotiates
+class SessionCache:
+    def __init__(self, max_sessions=SESSION_CACHE_SIZE, ttl=SESSION_TTL, rekey_after=REKEY_AFTER_MESSAGES):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.rekey_after = rekey_after
+        self.sessions = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, peer):
+        with self.lock:
+            session = self.sessions.get(peer)
+            if session is None:
+                return None
+            if time.monotonic() - session.created > self.ttl or session.messages >= self.rekey_after:
+                del self.sessions[peer]
+                return None
+            self.sessions.move_to_end(peer)
+            return session
+
+    def put(self, peer, session):
+        with self.lock:
+            self.sessions[peer] = session
+            self.sessions.move_to_end(peer)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def discard(self, peer):
+        with self.lock:
+            self.sessions.pop(peer, None)
+
+    def __contains__(self, peer):
+        return self.get(peer) is not None
+
+# What a handshake signature covers: who it's from and to, the ephemeral key and whether it's a reply,
+# so a signed hello can't be passed off as one to someone else or as a reply
+def handshake_transcript(sender, recipient, ephemeral_key, reply):
+    return b"\0".join((b"msgapp handshake", sender.encode(), recipient.encode(), ephemeral_key, b"1" if reply else b"0"))
+
+# Identity keys of the peers we've completed a handshake with, pinned the first time each is seen; a
+# handshake signed by a different key for the same username is refused. Stored in the history database
+class TrustedIdentities:
+    def __init__(self, path=HISTORY_FILE):
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)  # Guarded by lock
+        self.db.execute("CREATE TABLE IF NOT EXISTS identities (username TEXT PRIMARY KEY, public_key BLOB NOT NULL)")
+        self.db.commit()
+
+    # True if key is the identity key pinned for username, pinning it if there is none yet
+    def check(self, username, key):
+        with self.lock:
+            row = self.db.execute("SELECT public_key FROM identities WHERE username = ?", (username,)).fetchone()
+            if row is not None:
+                return row[0] == key
+            with self.db:
+                self.db.execute("INSERT INTO identities (username, public_key) VALUES (?, ?)", (username, key))
+            return True
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# Named groups and their sender keys. Each member encrypts its group messages once, under its own sender
+# key, and hands that key to the other members over their pairwise sessions; sending to a group then costs
+# one encryption whatever its size. Group members are stored in the history database, keys only in memory;
+# the outbox keeps group messages unencrypted and seals them under our current key each time they're sent,
+# so a message never waits on a key that has been rotated or lost in a restart
+class GroupDirectory:
+    def __init__(self, path=HISTORY_FILE, rekey_after=REKEY_AFTER_MESSAGES):
+        self.rekey_after = rekey_after
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)  # Guarded by lock
+        self.db.execute("CREATE TABLE IF NOT EXISTS groups (name TEXT PRIMARY KEY, members TEXT NOT NULL, owner TEXT)")
+        if "owner" not in [column[1] for column in self.db.execute("PRAGMA table_info(groups)")]:
+            self.db.execute("ALTER TABLE groups ADD COLUMN owner TEXT")  # Groups from before owners; nobody can change them
+        self.db.commit()
+        self.groups = {}
+        self.owners = {}  # Group -> the member who created it, the only one whose member list changes are taken
+        for name, members, owner in self.db.execute("SELECT name, members, owner FROM groups"):
+            self.groups[name] = json.loads(members)
+            self.owners[name] = owner
+        self.own_keys = {}  # Group -> SessionCipher we encrypt our group messages with
+        self.sender_keys = {}  # (group, sender) -> SessionCipher for the sender's group messages
+
+    # Store a group's members, and its owner if given; returns True if the group is new to us. Keys of
+    # senders who are no longer members are forgotten
+    def set_members(self, group, members, owner=None):
+        members = sorted(set(members))
+        with self.lock:
+            new = group not in self.groups
+            owner = owner or self.owners.get(group)
+            if self.groups.get(group) != members or self.owners.get(group) != owner:
+                self.groups[group] = members
+                self.owners[group] = owner
+                with self.db:
+                    self.db.execute("INSERT OR REPLACE INTO groups (name, members, owner) VALUES (?, ?, ?)",
+                                    (group, json.dumps(members), owner))
+            for key in [key for key in self.sender_keys if key[0] == group and key[1] not in members]:
+                del self.sender_keys[key]
+            return new
+
+    # Forget a group, e.g. after its owner removed us from it
+    def remove(self, group):
+        with self.lock:
+            self.groups.pop(group, None)
+            self.owners.pop(group, None)
+            self.own_keys.pop(group, None)
+            for key in [key for key in self.sender_keys if key[0] == group]:
+                del self.sender_keys[key]
+            with self.db:
+                self.db.execute("DELETE FROM groups WHERE name = ?", (group,))
+
+    def members(self, group):
+        with self.lock:
+            return list(self.groups.get(group, ()))
+
+    def owner(self, group):
+        with self.lock:
+            return self.owners.get(group)
+
+    def __contains__(self, group):
+        with self.lock:
+            return group in self.groups
+
+    # Our sender key for a group, as (cipher, fresh). A new key is made if there is none yet, it has used up
+    # its message budget or rotate is set (members changed), and fresh tells the caller to hand it out
+    def own_key(self, group, rotate=False):
+        with self.lock:
+            cipher = self.own_keys.get(group)
+            if cipher is None or rotate or cipher.messages >= self.rekey_after:
+                cipher = self.own_keys[group] = SessionCipher(generate_aes_key())
+                return cipher, True
+            return cipher, False
+
+    def current_key(self, group):
+        with self.lock:
+            return self.own_keys.get(group)
+
+    def sender_key(self, group, sender):
+        with self.lock:
+            return self.sender_keys.get((group, sender))
+
+    def add_sender_key(self, group, sender, key):
+        with self.lock:
+            self.sender_keys[(group, sender)] = SessionCipher(key)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# A file being received. Chunks are written into a .part file at their offsets as they arrive, in any
+# order, and the SHA-256 of each is kept in a progress file next to it so an interrupted download resumes
+# with only the missing chunks. Each chunk must match the hash the sender put in its offer, and before the
+# file is handed over every chunk on disk is checked again
+class IncomingFile:
+    def __init__(self, transfer_id, sender, name, size, chunk_size, expected, directory=DOWNLOAD_DIR):
+        self.transfer_id = transfer_id
+        self.sender = sender
+        self.name = os.path.basename(name) or "download"
+        self.size = size
+        self.chunk_size = chunk_size
+        self.expected = expected  # Hex SHA-256 of each chunk, from the offer
+        self.directory = directory
+        self.path = os.path.join(directory, transfer_id + ".part")
+        self.state_path = self.path + ".json"
+        self.hashes = [None] * ((size + chunk_size - 1) // chunk_size)  # Hex SHA-256 of each chunk written
+        self.remaining = len(self.hashes)
+        self.requested = set()  # Chunks asked for and not received yet
+        self.last_progress = time.monotonic()
+        self.last_saved = 0
+        self.lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.state_path) and os.path.exists(self.path):
+            with open(self.state_path) as f:
+                hashes = json.load(f)["hashes"]
+            if len(hashes) == len(self.hashes):
+                self.hashes = hashes
+                self.remaining = hashes.count(None)
+        self.file = open(self.path, "r+b" if os.path.exists(self.path) else "w+b")
+        self.file.truncate(size)
+
+    # Resume every download whose progress file is in the directory
+    @classmethod
+    def load_all(cls, directory=DOWNLOAD_DIR):
+        downloads = []
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.endswith(".part.json") and is_transfer_id(name[:-len(".part.json")]):
+                    try:
+                        with open(os.path.join(directory, name)) as f:
+                            state = json.load(f)
+                        downloads.append(cls(name[:-len(".part.json")], state["sender"], state["name"],
+                                             state["size"], state["chunk_size"], state["expected"], directory))
+                    except Exception as e:
+                        print(f"Error resuming download {name}: {e}")
+        return downloads
+
+    # Up to limit chunks that are neither written nor already requested, which are then marked requested
+    def next_chunks(self, limit):
+        with self.lock:
+            chunks = []
+            for index, digest in enumerate(self.hashes):
+                if len(chunks) >= limit:
+                    break
+                if digest is None and index not in self.requested:
+                    chunks.append(index)
+            self.requested.update(chunks)
+            return chunks
+
+    # Forget outstanding requests after a stall so the next request asks for them again
+    def reset_requests(self):
+        with self.lock:
+            self.requested.clear()
+
+    def outstanding(self):
+        with self.lock:
+            return len(self.requested)
+
+    # Store a chunk; returns True once every chunk has been written
+    def write(self, index, data):
+        if index >= len(self.hashes) or len(data) != min(self.chunk_size, self.size - index * self.chunk_size):
+            raise ValueError(f"Bad chunk {index} for {self.name}")
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            self.requested.discard(index)
+            if digest != self.expected[index]:
+                raise ValueError(f"Chunk {index} of {self.name} doesn't match the offer")
+            if self.hashes[index] is not None:
+                return False  # Duplicate from a re-request
+            self.file.seek(index * self.chunk_size)
+            self.file.write(data)
+            self.hashes[index] = digest
+            self.remaining -= 1
+            self.last_progress = time.monotonic()
+            if self.remaining and self.last_progress - self.last_saved < FILE_STATE_SAVE_INTERVAL:
+                return False
+            self.save_state()
+            return self.remaining == 0
+
+    # Must be called with lock held; the data is flushed first so the progress file never runs ahead of it
+    def save_state(self):
+        self.file.flush()
+        state = {"sender": self.sender, "name": self.name, "size": self.size, "chunk_size": self.chunk_size,
+                 "expected": self.expected, "hashes": self.hashes}
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.state_path + ".tmp", self.state_path)
+        self.last_saved = self.last_progress
+
+    # Check every chunk on disk against the offer. Chunks that don't match are marked missing and False is
+    # returned; otherwise the file is moved to its final name, which is returned
+    def finish(self):
+        with self.lock:
+            self.file.seek(0)
+            for index in range(len(self.hashes)):
+                if hashlib.sha256(self.file.read(self.chunk_size)).hexdigest() != self.expected[index]:
+                    self.hashes[index] = None
+                    self.remaining += 1
+            if self.remaining:
+                self.save_state()
+                return False
+            self.file.close()
+            base, ext = os.path.splitext(self.name)
+            path, copy = os.path.join(self.directory, self.name), 1
+            while os.path.exists(path):
+                path = os.path.join(self.directory, f"{base} ({copy}){ext}")
+                copy += 1
+            os.replace(self.path, path)
+            os.remove(self.state_path)
+            return path
+
+    # Give up on the download and delete what was received
+    def discard(self):
+        with self.lock:
+            self.file.close()
+            for path in (self.path, self.state_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def close(self):
+        with self.lock:
+            if self.remaining:
+                self.save_state()
+            self.file.close()
 
 # Send message directly to a user on the LAN
-def send_lan_message(recipient_ip, username, encrypted_message):
+def send_lan_message(lan_transport, recipient_ip, username, session, message, compress=False):
+    lan_transport.send(session.encrypt(username, message, compress), (recipient_ip, BROADCAST_PORT))
+
+# True if value is a string of length lowercase hex digits
+def is_hex(value, length):
+    return isinstance(value, str) and len(value) == length and all(c in "0123456789abcdef" for c in value)
+
+# True if a peer-supplied transfer id is one we'd generate (16 random bytes in lowercase hex); it names
+# files in the download directory, so anything else could point outside it
+def is_transfer_id(value):
+    return is_hex(value, 32)
+
+# True if a file offer from a peer is one we can take: a name, a size within MAX_FILE_SIZE, our chunk size
+# (anything else would have us allocate per-chunk state for a tiny chunk size) and a SHA-256 for every chunk
+def is_file_offer(offer):
+    size, chunk_hashes = offer.get("size"), offer.get("hashes")
+    return (is_transfer_id(offer.get("file_offer")) and isinstance(offer.get("name"), str)
+            and type(size) is int and 0 <= size <= MAX_FILE_SIZE and offer.get("chunk_size") == FILE_CHUNK_SIZE
+            and isinstance(chunk_hashes, list) and len(chunk_hashes) == (size + FILE_CHUNK_SIZE - 1) // FILE_CHUNK_SIZE
+            and all(is_hex(digest, 64) for digest in chunk_hashes))
+
+# Hex SHA-256 of each chunk of a file, for its offer
+def hash_file_chunks(path):
+    with open(path, "rb") as f:
+        return [hashlib.sha256(chunk).hexdigest() for chunk in iter(lambda: f.read(FILE_CHUNK_SIZE), b'')]
+
+# Size and modification time of a file, which must be the same when its chunks are sent as when it was offered
+def file_version(path):
+    info = os.stat(path)
+    return [info.st_size, info.st_mtime_ns]
+
+# Offers we've made that haven't been received yet, as {transfer id: [path, recipient, size, mtime]}. Offers
+# whose file has gone or changed since are left out, so the receiver is told it's no longer available
+def load_outgoing_files(path=OUTGOING_FILES_FILE):
+    if not os.path.exists(path):
+        return {}
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            payload = json.dumps({
-                "from": username,
-                "message": encrypted_message
-            })
-            sock.sendto(payload.encode(), (recipient_ip, BROADCAST_PORT))
-            print("LAN message sent.")
+        with open(path) as f:
+            offers = json.load(f)
     except Exception as e:
-        print(f"Error sending LAN message: {e}")
+        print(f"Error loading offered files: {e}")
+        return {}
+    return {transfer_id: offer + [deque(), None] for transfer_id, offer in offers.items()
+            if len(offer) == 4 and os.path.exists(offer[0]) and file_version(offer[0]) == offer[2:]}
+
+def save_outgoing_files(outgoing_files, path=OUTGOING_FILES_FILE):
+    with open(path + ".tmp", "w") as f:
+        json.dump({transfer_id: transfer[:4] for transfer_id, transfer in outgoing_files.items()}, f)
+    os.replace(path + ".tmp", path)
+
+# Path of an update file in the update cache, or None if the key isn't a SHA-256 or git blob SHA-1 in hex
+def update_cache_path(key):
+    if len(key) not in (40, 64) or any(c not in "0123456789abcdef" for c in key):
+        return None
+    return os.path.join(UPDATE_CACHE_DIR, key)
 
 # Start the update checker process
 def start_update_checker():
@@ -149,21 +1120,367 @@ def load_theme_settings():
             return json.load(f)
     return {"theme": "light"}  # Default theme
 
-# Save theme settings to JSON file
+# Save theme settings to JSON file, keeping any other settings stored alongside
 def save_theme_settings(theme):
+    settings = load_theme_settings()
+    settings["theme"] = theme
     with open(THEME_FILE, 'w') as f:
-        json.dump({"theme": theme}, f)
+        json.dump(settings, f)
+
+# Append-only message history in SQLite (WAL mode), indexed by conversation and timestamp so only the
+# pages actually shown ever get read
+class MessageHistory:
+    def __init__(self, path=HISTORY_FILE):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY, conversation TEXT NOT NULL, timestamp REAL NOT NULL, "
+            "sender TEXT NOT NULL, body TEXT NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation, timestamp)")
+        self.fts = self.create_search_index()
+        self.db.commit()
+
+    # Full-text index over the history, kept up to date by a trigger as messages are appended. Returns
+    # False if this SQLite build has no FTS5, in which case search falls back to a table scan
+    def create_search_index(self):
+        exists = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        try:
+            self.db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+                "body, sender, conversation, content='messages', content_rowid='id')"
+            )
+        except sqlite3.OperationalError:
+            return False
+        self.db.execute(
+            "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+            "INSERT INTO messages_fts (rowid, body, sender, conversation) "
+            "VALUES (new.id, new.body, new.sender, new.conversation); END"
+        )
+        if not exists:
+            self.db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")  # Index older history
+        return True
+
+    # Store (conversation, sender, body) entries in one transaction; returns the stored rows
+    def append_many(self, entries):
+        rows = []
+        with self.db:
+            for conversation, sender, body in entries:
+                timestamp = time.time()
+                cursor = self.db.execute(
+                    "INSERT INTO messages (conversation, timestamp, sender, body) VALUES (?, ?, ?, ?)",
+                    (conversation, timestamp, sender, body)
+                )
+                rows.append((cursor.lastrowid, conversation, timestamp, sender, body))
+        return rows
+
+    # The page of messages before before_id (or the latest page), oldest first
+    def page(self, before_id=None, limit=HISTORY_PAGE_SIZE):
+        if before_id is None:
+            cursor = self.db.execute(
+                "SELECT id, conversation, timestamp, sender, body FROM messages ORDER BY id DESC LIMIT ?", (limit,))
+        else:
+            cursor = self.db.execute(
+                "SELECT id, conversation, timestamp, sender, body FROM messages WHERE id < ? ORDER BY id DESC LIMIT ?",
+                (before_id, limit))
+        return cursor.fetchall()[::-1]
+
+    # Best matching messages for a search, most relevant first
+    def search(self, query, limit=SEARCH_LIMIT):
+        terms = query.split()
+        if not terms:
+            return []
+        if not self.fts:
+            cursor = self.db.execute(
+                "SELECT id, conversation, timestamp, sender, body FROM messages WHERE body LIKE ? "
+                "ORDER BY id DESC LIMIT ?", (f"%{query}%", limit))
+            return cursor.fetchall()
+        # Quote each term so user input can't be parsed as FTS syntax, and prefix-match it
+        match = " ".join('"' + term.replace('"', '""') + '"*' for term in terms)
+        cursor = self.db.execute(
+            "SELECT m.id, m.conversation, m.timestamp, m.sender, m.body FROM messages_fts "
+            "JOIN messages m ON m.id = messages_fts.rowid WHERE messages_fts MATCH ? ORDER BY rank LIMIT ?",
+            (match, limit))
+        return cursor.fetchall()
+
+    # Messages from the same conversation either side of message_id, oldest first
+    def context(self, message_id, radius=SEARCH_CONTEXT):
+        row = self.db.execute("SELECT conversation FROM messages WHERE id = ?", (message_id,)).fetchone()
+        if row is None:
+            return []
+        before = self.db.execute(
+            "SELECT id, conversation, timestamp, sender, body FROM messages WHERE conversation = ? AND id < ? "
+            "ORDER BY id DESC LIMIT ?", (row[0], message_id, radius)).fetchall()
+        after = self.db.execute(
+            "SELECT id, conversation, timestamp, sender, body FROM messages WHERE conversation = ? AND id >= ? "
+            "ORDER BY id LIMIT ?", (row[0], message_id, radius + 1)).fetchall()
+        return before[::-1] + after
+
+    def close(self):
+        self.db.close()
+
+# Persistent outbox of LAN messages. Each recipient has a FIFO queue; messages stay queued (and on disk)
+# until the recipient acknowledges them, are retransmitted with exponential backoff while unacknowledged,
+# and drain when the recipient reappears in the peer directory. All queue work runs on the transport loop,
+# so enqueueing from the GUI never blocks
+class Outbox:
+    def __init__(self, loop, known_users, transmit, path=HISTORY_FILE, on_delivered=None):
+        self.loop = loop
+        self.known_users = known_users
+        self.transmit = transmit  # Called with (recipient, payload) to encrypt (if needed) and send one message
+        self.on_delivered = on_delivered  # Called on the loop with (recipient, message id) when a message is acknowledged
+        self.queues = {}  # Recipient -> deque of [message id, payload, next retry time, retry delay]
+        self.retry_task = None
+        self.db = sqlite3.connect(path, check_same_thread=False)  # Only used from the transport loop once started
+        # Every enqueue and ack commits on the network loop, so commits mustn't each wait for an fsync. With
+        # WAL and NORMAL a power cut can lose the last few changes (a message resent or not sent), never corrupt the queue
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.create_table()
+        for message_id, recipient, payload in self.db.execute("SELECT id, recipient, payload FROM outbox ORDER BY rowid"):
+            self.queues.setdefault(recipient, deque()).append([message_id, payload, None, RETRY_INITIAL])
+
+    # Entries are keyed by recipient and id, since a group message is queued under one id for every member.
+    # Outboxes from before group messages were keyed by id alone and are moved over to the new table
+    def create_table(self):
+        keys = [column[1] for column in self.db.execute("PRAGMA table_info(outbox)") if column[5]]
+        with self.db:
+            if keys == ["id"]:
+                self.db.execute("ALTER TABLE outbox RENAME TO outbox_old")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS outbox (id TEXT NOT NULL, recipient TEXT NOT NULL, payload TEXT NOT NULL, "
+                "PRIMARY KEY (recipient, id))"
+            )
+            if keys == ["id"]:
+                self.db.execute("INSERT INTO outbox (id, recipient, payload) SELECT id, recipient, payload FROM outbox_old ORDER BY rowid")
+                self.db.execute("DROP TABLE outbox_old")
+
+    def start(self):
+        self.loop.call_soon_threadsafe(self.begin)
+
+    def begin(self):
+        self.retry_task = self.loop.create_task(self.retry_loop())
+        for recipient in list(self.queues):
+            self.pump(recipient)
+
+    def stop(self):
+        def close():
+            if self.retry_task:
+                self.retry_task.cancel()
+            self.db.close()
+        self.loop.call_soon_threadsafe(close)
+
+    # Queue a message for a recipient, with any extra fields the recipient should get alongside the text;
+    # safe to call from any thread. Returns the message id
+    def enqueue(self, recipient, text, **fields):
+        message_id = os.urandom(8).hex()
+        payload = json.dumps({"id": message_id, "text": text, **fields})
+        self.loop.call_soon_threadsafe(self.add, [recipient], message_id, payload)
+        return message_id
+
+    # Queue a group message for every member. If it already went out to all of them at once, sent is True
+    # and members are only sent their own copy if they don't acknowledge it in time
+    def enqueue_group(self, members, message_id, group, text, sent=False):
+        payload = json.dumps({"id": message_id, "text": text, "to_group": group})
+        self.loop.call_soon_threadsafe(self.add, members, message_id, payload, sent)
+
+    def add(self, recipients, message_id, payload, sent=False):
+        with self.db:
+            self.db.executemany("INSERT INTO outbox (id, recipient, payload) VALUES (?, ?, ?)",
+                                [(message_id, recipient, payload) for recipient in recipients])
+        for recipient in recipients:
+            entry = [message_id, payload, None, RETRY_INITIAL]
+            if sent:
+                entry[2], entry[3] = time.monotonic() + RETRY_INITIAL, min(RETRY_INITIAL * 2, RETRY_MAX)
+            self.queues.setdefault(recipient, deque()).append(entry)
+            self.pump(recipient)
+
+    # The recipient confirmed a message; safe to call from any thread. With delivered False the message is
+    # just dropped, without reporting it as delivered
+    def acknowledge(self, recipient, message_id, delivered=True):
+        self.loop.call_soon_threadsafe(self.remove, recipient, message_id, delivered)
+
+    def remove(self, recipient, message_id, delivered=True):
+        queue = self.queues.get(recipient)
+        if not queue:
+            return
+        for entry in queue:
+            if entry[0] == message_id:
+                queue.remove(entry)
+                with self.db:
+                    self.db.execute("DELETE FROM outbox WHERE recipient = ? AND id = ?", (recipient, message_id))
+                if delivered and self.on_delivered:
+                    self.on_delivered(recipient, message_id)
+                break
+        if not queue:
+            del self.queues[recipient]
+        else:
+            self.pump(recipient)
+
+    # The recipient is back; resend whatever is in flight straight away; safe to call from any thread
+    def peer_joined(self, recipient):
+        def resume():
+            for entry in self.queues.get(recipient, ()):
+                entry[2], entry[3] = None, RETRY_INITIAL
+            self.pump(recipient)
+        self.loop.call_soon_threadsafe(resume)
+
+    # Send anything in the recipient's window that hasn't been sent yet
+    def pump(self, recipient):
+        if recipient not in self.known_users:
+            return
+        for entry in list(islice(self.queues.get(recipient, ()), OUTBOX_WINDOW)):
+            if entry[2] is None:
+                self.send_entry(recipient, entry)
+
+    def send_entry(self, recipient, entry):
+        entry[2] = time.monotonic() + entry[3]
+        entry[3] = min(entry[3] * 2, RETRY_MAX)
+        try:
+            self.transmit(recipient, entry[1])
+        except Exception as e:
+            print(f"Error sending queued message to {recipient}: {e}")
+
+    async def retry_loop(self):
+        while True:
+            await asyncio.sleep(0.5)
+            now = time.monotonic()
+            for recipient, queue in list(self.queues.items()):
+                if recipient not in self.known_users:
+                    continue
+                for entry in list(islice(queue, OUTBOX_WINDOW)):
+                    if entry[2] is not None and entry[2] <= now:
+                        self.send_entry(recipient, entry)
+
+# Render layer for the chat window. Pending lines are coalesced into one insert per frame, the window
+# keeps at most max_lines lines (trimming the oldest while the user is at the bottom) and only
+# autoscrolls if the user is at the bottom. Messages are (history id, text) pairs; the id is None for
+# lines that aren't stored. A message can carry a third item, a delivery key, in which case its delivery
+# status is shown after it and kept up to date by set_status
+class ChatRenderer:
+    def __init__(self, root, chat_window, max_lines=MAX_CHAT_LINES):
+        self.root = root
+        self.chat_window = chat_window
+        self.max_lines = max_lines
+        self.line_count = 0
+        self.entries = deque()  # [history id, line count] for each message shown, top to bottom
+        self.pending = []
+        self.flush_scheduled = False
+        self.statuses = {}  # Delivery key -> (status, final) last set
+
+    def append(self, messages):
+        self.pending.extend(messages)
+        if len(self.pending) > self.max_lines:
+            del self.pending[:-self.max_lines]  # These would be trimmed straight away anyway
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.root.after(RENDER_INTERVAL, self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if not self.pending:
+            return
+        chunks = []  # Text and tag list pairs, inserted in one call
+        lines = 0
+        for message_id, message, *delivery in self.pending:
+            self.entries.append([message_id, message.count("\n") + 1])
+            lines += message.count("\n") + 1
+            chunks += [message, ()]
+            if delivery:
+                status, final = self.statuses.get(delivery[0], ("sending", False))
+                chunks += [f" ({status})", () if final else (f"status-{delivery[0]}",)]
+            chunks += ["\n", ()]
+        self.pending = []
+        at_bottom = self.chat_window.yview()[1] >= 1.0
+        self.chat_window.config(state=tk.NORMAL)
+        self.chat_window.insert(tk.END, *chunks)
+        self.line_count += lines
+        if at_bottom:
+            # Scrollback pages loaded above are only trimmed once the user is back at the bottom
+            trimmed = 0
+            while self.line_count - trimmed > self.max_lines and len(self.entries) > 1:
+                trimmed += self.entries.popleft()[1]
+            if trimmed:
+                self.chat_window.delete("1.0", f"{trimmed + 1}.0")
+                self.line_count -= trimmed
+        self.chat_window.config(state=tk.DISABLED)
+        if at_bottom:
+            self.chat_window.yview(tk.END)
+
+    # Change the delivery status shown after a message. Once it's final the message's tag is dropped, so
+    # Tk only tracks tags for messages still waiting on someone
+    def set_status(self, key, status, final=False):
+        self.statuses[key] = (status, final)
+        tag = f"status-{key}"
+        ranges = self.chat_window.tag_ranges(tag)
+        if ranges:
+            self.chat_window.config(state=tk.NORMAL)
+            self.chat_window.delete(ranges[0], ranges[1])
+            self.chat_window.insert(ranges[0], f" ({status})", () if final else (tag,))
+            self.chat_window.config(state=tk.DISABLED)
+        if final:
+            self.chat_window.tag_delete(tag)
+
+    # Insert a page of older messages above everything shown, keeping the view on the same line
+    def prepend(self, messages):
+        text = "".join(message + "\n" for _, message in messages)
+        for message_id, message in reversed(messages):
+            self.entries.appendleft([message_id, message.count("\n") + 1])
+        self.chat_window.config(state=tk.NORMAL)
+        self.chat_window.insert("1.0", text)
+        self.chat_window.config(state=tk.DISABLED)
+        inserted = text.count("\n")
+        self.line_count += inserted
+        self.chat_window.yview(f"{inserted + 1}.0")
+
+    # History id of the oldest stored message shown, or None
+    def oldest_id(self):
+        for message_id, _ in self.entries:
+            if message_id is not None:
+                return message_id
+        return None
 
 # Main messaging app class
 class MessagingApp:
     def __init__(self, username):
         self.username = username
-        self.private_key, self.public_key = generate_rsa_key_pair()
-        self.contacts = {}  # Stores session keys for each contact
-        self.known_users = {}  # Discovered users on LAN
-        self.theme = load_theme_settings()["theme"]  # Load theme setting
+        settings = load_theme_settings()
+        self.keystore = IdentityKeyStore(get_keystore_passphrase(), settings.get("identity_key_type", IDENTITY_KEY_TYPE))
+        self.keystore.load_async()  # Loads or generates the identity key while the GUI starts up
+        self.contacts = SessionCache()  # Stores a SessionCipher for each contact
+        self.identities = TrustedIdentities()
+        self.auth_failures = {}  # Peer -> frames in a row that failed to decrypt under their session
+        self.groups = GroupDirectory()
+        self.incoming_files = {f.transfer_id: f for f in IncomingFile.load_all()}  # Transfer id -> IncomingFile
+        self.outgoing_files = load_outgoing_files()  # Transfer id -> [path, recipient, size, mtime, chunks wanted, sending task]
+        self.outgoing_lock = Lock()  # Guards adding and removing outgoing files, and saving them
+        self.file_offers = deque()  # (sender, offer) waiting for the user to accept or decline
+        self.pending_handshakes = {}  # Peer -> (ephemeral key, sent time, messages waiting on the session)
+        self.handshake_lock = Lock()
+        self.receive_pool = ThreadPoolExecutor(max_workers=RECEIVE_WORKERS)
+        self.received = deque()  # Futures from receive_pool in arrival order, drained by pump_received
+        self.known_users = PeerDirectory(on_change=self.on_peer_change)  # Discovered users on LAN
+        self.peer_events = deque()  # Joins and leaves waiting to be shown in the chat window
+        self.theme = settings["theme"]  # Load theme setting
+        self.max_chat_lines = settings.get("max_chat_lines", MAX_CHAT_LINES)
+        self.history = MessageHistory()
+        self.more_history = True  # False once scrollback has reached the first stored message
+        self.loading_history = False
+        self.lan_transport = LanTransport(self.username, self.known_users, on_payload=self.handle_payload,
+                                          discovery_mode=settings.get("discovery_mode", DISCOVERY_MODE))
+        self.outbox = Outbox(self.lan_transport.loop, self.known_users, self.send_queued, on_delivered=self.on_delivered)
+        self.deliveries = {}  # Message id -> [recipients, acknowledged so far] for messages sent from the chat window
+        self.delivered = deque()  # Ids of acknowledged messages waiting to be shown
+        self.recent_ids = {}  # Sender -> OrderedDict of recently received message ids
+        self.recent_ids_lock = Lock()
         self.init_gui()
+        self.load_older_history()  # Only the last page; older pages load as the user scrolls up
         self.start_broadcast_listener()
+        self.root.after(RECEIVE_PUMP_INTERVAL, self.pump_received)
+        self.root.after(FILE_STALL_TIMEOUT * 1000, self.check_downloads)
+        self.root.after(RECEIVE_PUMP_INTERVAL, self.check_keystore)
 
     # Initialize GUI
     def init_gui(self):
@@ -173,7 +1490,17 @@ class MessagingApp:
         # Initialize the chat window first
         self.chat_window = scrolledtext.ScrolledText(self.root, width=50, height=20)
         self.chat_window.pack(padx=10, pady=10)
-        self.chat_window.config(state=tk.DISABLED)
+        self.chat_window.config(state=tk.DISABLED, yscrollcommand=self.on_chat_scroll)
+        self.renderer = ChatRenderer(self.root, self.chat_window, self.max_chat_lines)
+
+        # History search bar above the chat window
+        self.search_frame = tk.Frame(self.root)
+        self.search_frame.pack(fill=tk.X, padx=10, before=self.chat_window)
+        self.search_entry = tk.Entry(self.search_frame, width=40)
+        self.search_entry.pack(side=tk.LEFT)
+        self.search_entry.bind("<Return>", lambda event: self.search_history())
+        self.search_button = tk.Button(self.search_frame, text="Search", command=self.search_history)
+        self.search_button.pack(side=tk.LEFT, padx=5)
 
         self.entry = tk.Entry(self.root, width=40)
         self.entry.pack(side=tk.LEFT, padx=10, pady=10)
@@ -181,6 +1508,12 @@ class MessagingApp:
         self.send_button = tk.Button(self.root, text="Send", command=self.send_message)
         self.send_button.pack(side=tk.RIGHT, padx=10, pady=10)
 
+        self.group_button = tk.Button(self.root, text="New Group", command=self.create_group)
+        self.group_button.pack(side=tk.RIGHT, pady=10)
+
+        self.file_button = tk.Button(self.root, text="Send File", command=self.send_file)
+        self.file_button.pack(side=tk.RIGHT, pady=10)
+
         # Dark/Light mode toggle
         self.toggle_button = tk.Button(self.root, text="Toggle Dark/Light Mode", command=self.toggle_theme)
         self.toggle_button.pack(pady=10)
@@ -191,46 +1524,692 @@ class MessagingApp:
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
     def on_closing(self):
+        self.outbox.stop()
+        self.lan_transport.stop()
+        self.receive_pool.shutdown(wait=False, cancel_futures=True)
+        self.history.close()
+        self.groups.close()
+        self.identities.close()
+        for download in list(self.incoming_files.values()):
+            download.close()  # Keeps the progress so the download resumes next time
         self.root.quit()
 
-    # Start a thread to broadcast username and listen for broadcasts
+    # Start the LAN transport, which broadcasts our username and listens for other clients
     def start_broadcast_listener(self):
-        Thread(target=broadcast_username, args=(self.username,), daemon=True).start()
-        Thread(target=listen_for_broadcasts, args=(self.known_users, self.username), daemon=True).start()
+        self.lan_transport.start()
+        self.outbox.start()
 
-    # Add a message to the chat window
+    # Add a message to the chat window without storing it in the history
     def add_message(self, message):
-        self.chat_window.config(state=tk.NORMAL)
-        self.chat_window.insert(tk.END, message + "\n")
-        self.chat_window.config(state=tk.DISABLED)
-        self.chat_window.yview(tk.END)
+        self.renderer.append([(None, message)])
+
+    # Store (conversation, sender, body) entries in the history and show them in the chat window. A message
+    # we sent can be given as (message id, recipients) in delivery, to show its delivery status
+    def record_messages(self, entries, delivery=None):
+        rows = self.history.append_many(entries)
+        if delivery and delivery[1]:
+            self.deliveries[delivery[0]] = [delivery[1], 0]
+            self.renderer.append([(rows[0][0], self.format_message(rows[0]), delivery[0])])
+            return
+        self.renderer.append([(row[0], self.format_message(row)) for row in rows])
+
+    # Outbox hook for acknowledged messages; runs on the transport loop, so they're shown by pump_received
+    def on_delivered(self, recipient, message_id):
+        self.delivered.append(message_id)
+
+    # Update the status of a message we sent from the chat window: "delivered", or for a group how many
+    # members have it so far
+    def show_delivery(self, message_id):
+        delivery = self.deliveries.get(message_id)
+        if delivery is None:
+            return  # A key, file or other control message
+        delivery[1] += 1
+        if delivery[1] >= delivery[0]:
+            del self.deliveries[message_id]
+            self.renderer.set_status(message_id, "delivered", final=True)
+        else:
+            self.renderer.set_status(message_id, f"delivered to {delivery[1]} of {delivery[0]}")
+
+    def format_message(self, row):
+        message_id, conversation, timestamp, sender, body = row
+        if sender == self.username:
+            return f"You to {conversation}: {body}"
+        if conversation.startswith("#"):
+            return f"{sender} in {conversation}: {body}"
+        return f"{sender}: {body}"
 
-    # Retrieve or establish session key for a recipient
-    def get_session_key(self, recipient):
-        if recipient in self.contacts:
-            return self.contacts[recipient], None
+    # Watch the chat scrollbar and page in older history when the user reaches the top
+    def on_chat_scroll(self, first, last):
+        self.chat_window.vbar.set(first, last)
+        if float(first) <= 0.0 and float(last) < 1.0 and self.more_history and not self.loading_history:
+            self.loading_history = True
+            self.root.after_idle(self.load_older_history)
+
+    def load_older_history(self):
+        before_id = self.renderer.oldest_id()
+        if before_id is None and self.renderer.entries:
+            rows = []  # Nothing stored is shown, so there's nothing to page back from
         else:
-            # Fetch recipient's public key from the server (not implemented)
-            recipient_public_key = self.public_key  # For now, using self's public key for testing
-            aes_key, encrypted_aes_key = establish_session_key(self.private_key, recipient_public_key)
-            self.contacts[recipient] = aes_key
-            return aes_key, encrypted_aes_key
+            rows = self.history.page(before_id)
+        if len(rows) < HISTORY_PAGE_SIZE:
+            self.more_history = False
+        if rows:
+            messages = [(row[0], self.format_message(row)) for row in rows]
+            if self.renderer.entries:
+                self.renderer.prepend(messages)
+            else:
+                self.renderer.append(messages)
+        self.loading_history = False
+
+    # Search the history and show ranked hits; selecting a hit shows the conversation around it
+    def search_history(self):
+        query = self.search_entry.get()
+        results = self.history.search(query)
+        if not results:
+            messagebox.showinfo("Search", f"No messages found for '{query}'.")
+            return
+
+        window = tk.Toplevel(self.root)
+        window.title(f"Search results - {query}")
+        hits = tk.Listbox(window, width=70, height=10)
+        hits.pack(fill=tk.X, padx=10, pady=10)
+        for row in results:
+            when = time.strftime('%Y-%m-%d %H:%M', time.localtime(row[2]))
+            hits.insert(tk.END, f"[{when}] {self.format_message(row)}")
+        context = scrolledtext.ScrolledText(window, width=70, height=12)
+        context.pack(padx=10, pady=10)
+        context.tag_config("hit", background="yellow", foreground="black")
+        context.config(state=tk.DISABLED)
+
+        def show_context(event):
+            selection = hits.curselection()
+            if not selection:
+                return
+            hit_id = results[selection[0]][0]
+            context.config(state=tk.NORMAL)
+            context.delete("1.0", tk.END)
+            for row in self.history.context(hit_id):
+                context.insert(tk.END, self.format_message(row) + "\n", "hit" if row[0] == hit_id else ())
+            context.config(state=tk.DISABLED)
+            context.see("hit.first")
+
+        hits.bind("<<ListboxSelect>>", show_context)
+
+    # Called from the transport thread when a peer joins, moves or leaves
+    def on_peer_change(self, event, username, address):
+        if event == "join":
+            print(f"Discovered user {username} at {address}")
+            self.outbox.peer_joined(username)
+        elif event == "leave":
+            print(f"Lost user {username} at {address}")
+            self.lan_transport.close_stream(address)
+        if event != "update":
+            self.peer_events.append(f"* {username} {'joined' if event == 'join' else 'left'}")
+
+    # Tell the user once the keystore has loaded if the identity key couldn't be
+    def check_keystore(self):
+        if not self.keystore.ready.is_set():
+            self.root.after(RECEIVE_PUMP_INTERVAL, self.check_keystore)
+        elif self.keystore.error:
+            messagebox.showerror("Identity key", self.keystore.error)
+
+    # Move decoded messages into the chat window and history in arrival order, a batch per pump
+    # The next pump is always scheduled, so an error here loses at most this batch, never delivery itself
+    def pump_received(self):
+        try:
+            while self.peer_events:
+                self.add_message(self.peer_events.popleft())
+            while self.delivered:
+                self.show_delivery(self.delivered.popleft())
+            entries = []
+            while self.received and self.received[0].done() and len(entries) < RECEIVE_BATCH_SIZE:
+                future = self.received.popleft()
+                if not future.cancelled() and future.exception() is None and future.result():
+                    entries.append(future.result())
+            if entries:
+                self.record_messages(entries)
+            while self.file_offers:
+                self.accept_file(*self.file_offers.popleft())
+        except Exception as e:
+            print(f"Error delivering received messages: {e}")
+        finally:
+            self.root.after(RECEIVE_PUMP_INTERVAL, self.pump_received)
+
+    # Encrypt and send a message over the LAN, holding it back until a session has been negotiated
+    def send_secure(self, recipient, message, ip=None):
+        ip = ip or self.known_users[recipient]
+        with self.handshake_lock:
+            session = self.contacts.get(recipient)
+            if session is None:
+                self.start_handshake(recipient, ip)
+                self.pending_handshakes[recipient][2].append(message)
+                return
+        send_lan_message(self.lan_transport, ip, self.username, session, message, self.can_compress(recipient))
+
+    # True if the peer can take compressed messages
+    def can_compress(self, peer):
+        return "zlib" in self.known_users.capabilities(peer)
+
+    # Outbox transmit hook: group messages are sealed under our current sender key for the group (handing
+    # out a new one first if we have none since a restart), everything else under the recipient's pairwise session
+    def send_queued(self, recipient, payload):
+        body = json.loads(payload)
+        group = body.get("to_group")
+        if group is None:
+            self.send_secure(recipient, payload)
+            return
+        if recipient not in self.groups.members(group):
+            self.outbox.acknowledge(recipient, body["id"], delivered=False)  # Removed from the group since it was queued
+            return
+        cipher, fresh = self.groups.own_key(group)
+        if fresh:
+            self.distribute_group_key(group, cipher, [member for member in self.groups.members(group) if member != self.username])
+        frame = cipher.seal(os.urandom(NONCE_SIZE), pack_group_header(group, self.username),
+                            json.dumps({"id": body["id"], "text": body["text"]}), self.can_compress(recipient))
+        self.lan_transport.send(frame, (self.known_users[recipient], BROADCAST_PORT))
+
+    # Send a message to a group: it is encrypted once under our sender key for the group, multicast to
+    # the whole LAN in one datagram where possible, and retransmitted per member until each acknowledges.
+    # Returns the message id and the number of members it went to
+    def send_group(self, group, text):
+        members = [member for member in self.groups.members(group) if member != self.username]
+        cipher, fresh = self.groups.own_key(group)
+        if fresh:
+            self.distribute_group_key(group, cipher, members)
+        message_id = os.urandom(8).hex()
+        frame = cipher.seal(os.urandom(NONCE_SIZE), pack_group_header(group, self.username),
+                            json.dumps({"id": message_id, "text": text}),
+                            all(self.can_compress(member) for member in members))
+        # A new key can't have reached the members yet, so its first message waits in the outbox behind it
+        sent = (not fresh and self.lan_transport.discovery_addr[0] == MULTICAST_GROUP
+                and len(frame) <= MAX_DATAGRAM_SIZE)
+        if sent:
+            self.lan_transport.send(frame, self.lan_transport.discovery_addr)
+        self.outbox.enqueue_group(members, message_id, group, text, sent)
+        return message_id, len(members)
+
+    # Hand our sender key for a group to members over their pairwise sessions, along with the member list
+    # and owner
+    def distribute_group_key(self, group, cipher, members):
+        key = base64.b64encode(cipher.aes_key).decode()
+        member_list = self.groups.members(group)
+        owner = self.groups.owner(group)
+        for member in members:
+            self.outbox.enqueue(member, "", group=group, members=member_list, owner=owner, key=key)
+
+    # Replace our sender key for a group after its members changed, so members who were removed can't read
+    # what we send next and new ones get our key. Nothing to do if we haven't sent to the group yet
+    def rotate_group_key(self, group):
+        if self.groups.current_key(group) is None:
+            return
+        cipher, fresh = self.groups.own_key(group, rotate=True)
+        self.distribute_group_key(group, cipher, [member for member in self.groups.members(group) if member != self.username])
+
+    # The owner of a group changed its members: take the new list and rotate our own key, or forget the
+    # group if we were removed
+    def update_group_members(self, group, owner, members):
+        if self.username not in members:
+            self.groups.remove(group)
+            self.peer_events.append(f"* {owner} removed you from #{group}")
+            return
+        self.groups.set_members(group, members)
+        self.rotate_group_key(group)
+        self.peer_events.append(f"* #{group}: {', '.join(self.groups.members(group))}")
+
+    # Create a group, or change the members of one we own. The new member list goes out with our rotated
+    # key, and every member who gets it rotates their own key too (see update_group_members), so members
+    # who were removed can't read what anyone sends next
+    def create_group(self):
+        group = simpledialog.askstring("New Group", "Enter group name:")
+        if not group:
+            return
+        owner = self.groups.owner(group)
+        if group in self.groups and owner not in (None, self.username):
+            messagebox.showerror("Error", f"Only {owner} can change the members of #{group}.")
+            return
+        members = simpledialog.askstring("New Group", "Enter member usernames, separated by commas:",
+                                         initialvalue=", ".join(self.groups.members(group)))
+        members = [member.strip() for member in (members or "").split(",") if member.strip()]
+        if not members:
+            return
+        removed = [member for member in self.groups.members(group) if member not in members + [self.username]]
+        self.groups.set_members(group, members + [self.username], owner=self.username)
+        cipher, fresh = self.groups.own_key(group, rotate=True)
+        self.distribute_group_key(group, cipher, [member for member in self.groups.members(group) if member != self.username])
+        for member in removed:
+            # The new member list without a key, so they stop sending to the group
+            self.outbox.enqueue(member, "", group=group, members=self.groups.members(group), owner=self.username)
+        self.add_message(f"* #{group}: {', '.join(self.groups.members(group))}")
+
+    # Offer a file to a peer. The file is read once on a background thread to hash its chunks for the offer;
+    # nothing more is read until they accept and ask for chunks
+    def send_file(self):
+        path = filedialog.askopenfilename(title="Send File")
+        if not path:
+            return
+        recipient = simpledialog.askstring("Recipient", "Enter recipient username:")
+        if not recipient:
+            return
+        Thread(target=self.offer_file, args=(path, recipient), daemon=True).start()
+
+    def offer_file(self, path, recipient):
+        name = os.path.basename(path)
+        try:
+            version = file_version(path)
+            chunk_hashes = hash_file_chunks(path)
+            if file_version(path) != version:
+                raise ValueError("it changed while being read")
+        except Exception as e:
+            self.peer_events.append(f"* Couldn't offer {name}: {e}")
+            return
+        transfer_id = os.urandom(16).hex()
+        with self.outgoing_lock:
+            self.outgoing_files[transfer_id] = [path, recipient] + version + [deque(), None]
+            save_outgoing_files(self.outgoing_files)
+        self.outbox.enqueue(recipient, "", file_offer=transfer_id, name=name, size=version[0],
+                            chunk_size=FILE_CHUNK_SIZE, hashes=chunk_hashes)
+        self.peer_events.append(f"* Offered {name} ({version[0]} bytes) to {recipient}")
+
+    # A peer asked for chunks of a file we offered them; runs on the transport loop
+    def queue_file_chunks(self, recipient, transfer_id, chunks):
+        transfer = self.outgoing_files.get(transfer_id)
+        if transfer is None or transfer[1] != recipient:
+            self.send_secure(recipient, json.dumps({"file_cancel": transfer_id}))
+            return
+        transfer[4].extend(chunks)
+        if transfer[5] is None:
+            transfer[5] = self.lan_transport.loop.create_task(self.send_file_chunks(transfer_id))
+
+    # Stream requested chunks straight out of a memory-mapped file over the recipient's stream, each
+    # encrypted under their session, waiting for the socket to drain so only a few chunks are ever buffered.
+    # If the file has changed since it was offered its chunks no longer match the offer, so it's withdrawn
+    async def send_file_chunks(self, transfer_id):
+        transfer = self.outgoing_files[transfer_id]
+        path, recipient, size, mtime, wanted = transfer[:5]
+        try:
+            if not os.path.exists(path) or file_version(path) != [size, mtime]:
+                with self.outgoing_lock:
+                    self.outgoing_files.pop(transfer_id, None)
+                    save_outgoing_files(self.outgoing_files)
+                self.send_secure(recipient, json.dumps({"file_cancel": transfer_id}))
+                self.peer_events.append(f"* Withdrew {os.path.basename(path)} from {recipient}: it changed since it was offered")
+                return
+            session = self.contacts.get(recipient)
+            if session is None:
+                with self.handshake_lock:
+                    self.start_handshake(recipient, self.known_users[recipient])
+                wanted.clear()  # The recipient asks again when the download stalls
+                return
+            conn = await self.lan_transport.open_stream(self.known_users[recipient])
+            conn.transport.set_write_buffer_limits(high=4 * FILE_CHUNK_SIZE)
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                while wanted:
+                    index = wanted.popleft()
+                    chunk = data[index * FILE_CHUNK_SIZE:(index + 1) * FILE_CHUNK_SIZE]
+                    conn.write_frame(session.seal_bytes(os.urandom(NONCE_SIZE),
+                                                        pack_file_header(self.username, transfer_id, index), chunk))
+                    await conn.drain()
+        except Exception as e:
+            print(f"Error sending {os.path.basename(path)} to {recipient}: {e}")
+            wanted.clear()
+        finally:
+            transfer[5] = None
+
+    # The other end of a file transfer finished it, declined it or no longer has it
+    def end_transfer(self, peer, body):
+        transfer_id = body.get("file_done") or body.get("file_cancel")
+        transfer = self.outgoing_files.get(transfer_id)
+        if transfer is not None and transfer[1] == peer:
+            with self.outgoing_lock:
+                self.outgoing_files.pop(transfer_id, None)
+                save_outgoing_files(self.outgoing_files)
+            outcome = "received" if "file_done" in body else "declined"
+            self.peer_events.append(f"* {peer} {outcome} {os.path.basename(transfer[0])}")
+            return
+        download = self.incoming_files.get(transfer_id)
+        if download is not None and download.sender == peer and "file_cancel" in body:
+            del self.incoming_files[transfer_id]
+            download.discard()
+            self.peer_events.append(f"* {download.name} from {peer} is no longer available")
+
+    # Ask the user about a file offer; a repeated offer for a download already under way just resumes it
+    def accept_file(self, sender, offer):
+        transfer_id = offer["file_offer"]
+        download = self.incoming_files.get(transfer_id)
+        if download is None:
+            if not messagebox.askyesno("Incoming file",
+                                       f"{sender} wants to send you {offer['name']} ({offer['size']} bytes). Accept?"):
+                self.send_secure(sender, json.dumps({"file_cancel": transfer_id}))
+                return
+            download = IncomingFile(transfer_id, sender, offer["name"], offer["size"], offer["chunk_size"], offer["hashes"])
+            self.incoming_files[transfer_id] = download
+        if download.remaining == 0:
+            self.receive_pool.submit(self.complete_download, download)
+        else:
+            self.request_chunks(download)
+
+    # Ask the sender for enough chunks to fill the download's window
+    def request_chunks(self, download):
+        if download.sender not in self.known_users:
+            return  # Picked up again by check_downloads once they're back
+        chunks = download.next_chunks(FILE_WINDOW - download.outstanding())
+        if chunks:
+            self.send_secure(download.sender, json.dumps({"file_request": download.transfer_id, "chunks": chunks}))
+
+    # Decrypt and store a file chunk, topping up the request window once half of it has arrived. Runs on
+    # receive_pool, so chunks are decrypted and written in parallel
+    def handle_file_chunk(self, data, addr):
+        sender, transfer_id, index, header, nonce, ciphertext = unpack_file_frame(data)
+        download = self.incoming_files.get(transfer_id)
+        if download is None or download.sender != sender:
+            return None
+        session = self.contacts.get(sender)
+        if session is None:
+            with self.handshake_lock:
+                self.start_handshake(sender, addr[0])
+            return None
+        try:
+            chunk = session.open_bytes(header, nonce, ciphertext)
+        except InvalidTag:
+            print(f"Dropped corrupt or tampered file chunk from {sender}")
+            return None
+        if download.write(index, chunk):
+            # Verifying reads the whole file back, so it runs as its own task rather than holding up the
+            # messages queued behind this chunk
+            self.receive_pool.submit(self.complete_download, download)
+        elif download.outstanding() <= FILE_WINDOW // 2:
+            self.request_chunks(download)
+        return None
+
+    # Verify a fully written download and move it into place; chunks that fail verification are fetched
+    # again. Runs on receive_pool since it reads the whole file back
+    def complete_download(self, download):
+        if self.incoming_files.pop(download.transfer_id, None) is None:
+            return  # Already being completed
+        path = download.finish()
+        if not path:
+            self.incoming_files[download.transfer_id] = download
+            self.request_chunks(download)
+            return
+        self.send_secure(download.sender, json.dumps({"file_done": download.transfer_id}))
+        self.peer_events.append(f"* Received {download.name} from {download.sender}: {path}")
+
+    # Request missing chunks again for downloads that have stalled, e.g. because the sender went away and
+    # came back, or this is a download resumed from an earlier run
+    def check_downloads(self):
+        now = time.monotonic()
+        for download in list(self.incoming_files.values()):
+            if download.remaining == 0:
+                self.receive_pool.submit(self.complete_download, download)
+            elif download.sender in self.known_users and now - download.last_progress >= FILE_STALL_TIMEOUT:
+                download.reset_requests()
+                download.last_progress = now
+                self.request_chunks(download)
+        self.root.after(FILE_STALL_TIMEOUT * 1000, self.check_downloads)
+
+    # An updater on the LAN is looking for an update file; offer it if it's in our update cache
+    def answer_update_query(self, key, addr):
+        path = update_cache_path(key)
+        if path and os.path.exists(path):
+            self.lan_transport.send(json.dumps({"update_offer": key}).encode(), addr)
+
+    # Send a cached update file to the updater that asked for it, over the stream it opened: a header frame
+    # with the size, then the file in chunks. The updater checks the hash, so nothing here is trusted
+    async def serve_update(self, key, addr):
+        path = update_cache_path(key)
+        conn = self.lan_transport.connections.get(addr)
+        if not path or not os.path.exists(path) or conn is None:
+            return
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                conn.write_frame(json.dumps({"update_offer": key, "size": len(data)}).encode())
+                for offset in range(0, len(data), FILE_CHUNK_SIZE):
+                    conn.write_frame(data[offset:offset + FILE_CHUNK_SIZE])
+                    await conn.drain()
+        except Exception as e:
+            print(f"Error sending update to {addr[0]}: {e}")
+
+    # Send a handshake carrying a fresh ephemeral X25519 key; resent if the last one went unanswered.
+    # Must be called with handshake_lock held
+    def start_handshake(self, recipient, ip):
+        pending = self.pending_handshakes.get(recipient)
+        if pending and time.monotonic() - pending[1] < HANDSHAKE_TIMEOUT:
+            return
+        private_key = pending[0] if pending else x25519.X25519PrivateKey.generate()
+        waiting = pending[2] if pending else []
+        self.pending_handshakes[recipient] = (private_key, time.monotonic(), waiting)
+        self.send_handshake(recipient, ip, private_key, reply=False)
+
+    # The ephemeral key is signed with our identity key, which is sent along so the peer can pin it. While
+    # the identity key is still loading (or being generated on first run) the handshake goes out once it's
+    # ready, so nothing calling this, the transport loop included, waits on it
+    def send_handshake(self, recipient, ip, private_key, reply):
+        self.keystore.when_ready(lambda: self.sign_and_send_handshake(recipient, ip, private_key, reply))
+
+    def sign_and_send_handshake(self, recipient, ip, private_key, reply):
+        identity_key = self.keystore.private_key
+        if identity_key is None:
+            print(f"Can't start a session with {recipient}: no identity key")
+            return
+        ephemeral_key = public_key_bytes(private_key.public_key())
+        identity = identity_key.public_key().public_bytes(encoding=serialization.Encoding.DER,
+                                                          format=serialization.PublicFormat.SubjectPublicKeyInfo)
+        payload = json.dumps({
+            "type": "handshake",
+            "from": self.username,
+            "to": recipient,
+            "key": base64.b64encode(ephemeral_key).decode(),
+            "identity": base64.b64encode(identity).decode(),
+            "sig": base64.b64encode(sign_with_identity(
+                identity_key, handshake_transcript(self.username, recipient, ephemeral_key, reply))).decode(),
+            "reply": reply
+        })
+        self.lan_transport.send(payload.encode(), (ip, BROADCAST_PORT))
+
+    # Complete a handshake from a peer: answer their hello, or finish one we started. The hello must be
+    # signed by the identity key pinned for the peer (or the first one seen from them), and a live session
+    # is only replaced from the address the peer is known at
+    def handle_handshake(self, data, addr):
+        peer = data["from"]
+        if data.get("to") != self.username:
+            return
+        ephemeral_key = base64.b64decode(data["key"])
+        identity = base64.b64decode(data["identity"])
+        try:
+            verify_identity_signature(serialization.load_der_public_key(identity), base64.b64decode(data["sig"]),
+                                      handshake_transcript(peer, self.username, ephemeral_key, bool(data.get("reply"))))
+        except InvalidSignature:
+            print(f"Dropped handshake from {addr[0]} with a bad signature for {peer}")
+            return
+        if not self.identities.check(peer, identity):
+            print(f"Dropped handshake from {addr[0]}: the identity key for {peer} has changed")
+            return
+        peer_key = x25519.X25519PublicKey.from_public_bytes(ephemeral_key)
+        with self.handshake_lock:
+            if peer in self.contacts and addr[0] != self.known_users.get(peer):
+                print(f"Dropped handshake for {peer} from unexpected address {addr[0]}")
+                return
+            pending = self.pending_handshakes.get(peer)
+            if data.get("reply"):
+                if pending is None:
+                    return  # Stale reply to a handshake we already finished
+                private_key = pending[0]
+            else:
+                if pending and self.username < peer:
+                    return  # Both sides started at once; the peer will answer ours instead
+                private_key = x25519.X25519PrivateKey.generate()
+                self.send_handshake(peer, addr[0], private_key, reply=True)
+            session = SessionCipher(establish_session_key(private_key, peer_key))
+            self.contacts.put(peer, session)
+            self.auth_failures.pop(peer, None)
+            waiting = self.pending_handshakes.pop(peer, (None, None, []))[2]
+        compress = self.can_compress(peer)
+        for message in waiting:
+            send_lan_message(self.lan_transport, addr[0], self.username, session, message, compress)
+
+    # True if this message id from sender was already received (a retransmit whose ack got lost)
+    def is_duplicate(self, sender, message_id):
+        with self.recent_ids_lock:
+            recent = self.recent_ids.setdefault(sender, OrderedDict())
+            if message_id in recent:
+                return True
+            recent[message_id] = True
+            if len(recent) > RECENT_IDS:
+                recent.popitem(last=False)
+            return False
+
+    # Decrypt a message frame; returns a (conversation, sender, body) entry, or None if the frame is dropped.
+    # Messages are acknowledged (even duplicates, in case the first ack was lost), and acks are passed to the outbox
+    def handle_frame(self, data, addr):
+        sender = unpack_frame(data)[0]
+        session = self.contacts.get(sender)
+        if session is None:
+            # Our side of the session expired or never existed; renegotiate so the sender's next message gets through
+            with self.handshake_lock:
+                self.start_handshake(sender, addr[0])
+            return None
+        try:
+            body = json.loads(session.decrypt(data))
+        except InvalidTag:
+            print(f"Dropped corrupt or tampered message from {sender}")
+            self.auth_failed(sender, addr)
+            return None
+        if self.auth_failures:
+            self.auth_failures.pop(sender, None)
+        if "ack" in body:
+            self.outbox.acknowledge(sender, body["ack"])
+            return None
+        if "key_request" in body:
+            self.resend_group_key(body["key_request"], sender)
+            return None
+        if "file_request" in body:
+            self.lan_transport.loop.call_soon_threadsafe(
+                self.queue_file_chunks, sender, body["file_request"], body["chunks"])
+            return None
+        if "file_done" in body or "file_cancel" in body:
+            self.end_transfer(sender, body)
+            return None
+        self.send_secure(sender, json.dumps({"ack": body["id"]}), ip=addr[0])
+        if self.is_duplicate(sender, body["id"]):
+            return None
+        if "file_offer" in body:
+            if is_file_offer(body):
+                self.file_offers.append((sender, body))
+            else:
+                print(f"Dropped malformed file offer from {sender}")
+            return None
+        if "group" in body:
+            self.handle_group_update(sender, body)
+            return None
+        return sender, sender, body["text"]
+
+    # A member's sender key for a group, or (without a key) the owner telling a removed member. For a group
+    # new to us a key message also tells us who is in it and who owns it; for one we know, only members'
+    # keys are taken, and a new member list only from the owner
+    def handle_group_update(self, sender, body):
+        group = body["group"]
+        if group in self.groups:
+            if sender not in self.groups.members(group):
+                print(f"Ignored key for #{group} from {sender}, who isn't a member")
+                return
+            if sender == self.groups.owner(group) and sorted(set(body["members"])) != self.groups.members(group):
+                self.update_group_members(group, sender, body["members"])
+                if group not in self.groups:
+                    return
+        elif body.get("key") and sender in body["members"] and self.username in body["members"]:
+            self.groups.set_members(group, body["members"], body.get("owner") or sender)
+            self.peer_events.append(f"* {sender} added you to #{group}")
+        else:
+            return
+        if body.get("key"):
+            self.groups.add_sender_key(group, sender, base64.b64decode(body["key"]))
+
+    # Count a frame from the peer's known address that failed to decrypt. Several in a row mean the two
+    # sides hold different session keys (say a reply was lost while a hello was resent), so the session is
+    # dropped and renegotiated instead of staying broken until it expires
+    def auth_failed(self, sender, addr):
+        if addr[0] != self.known_users.get(sender):
+            return
+        with self.handshake_lock:
+            self.auth_failures[sender] = self.auth_failures.get(sender, 0) + 1
+            if self.auth_failures[sender] >= AUTH_FAILURE_LIMIT:
+                del self.auth_failures[sender]
+                self.contacts.discard(sender)
+                self.start_handshake(sender, addr[0])
+
+    # Decrypt a group frame; returns a (conversation, sender, body) entry, or None if the frame is dropped.
+    # Frames from a member that we can't decrypt mean we're missing the sender's current key, so we ask for it;
+    # frames for groups we're not in, or from senders who aren't members, are ignored
+    def handle_group_frame(self, data, addr):
+        group, sender, header, nonce, ciphertext = unpack_group_frame(data)
+        if sender == self.username or sender not in self.groups.members(group):
+            return None
+        cipher = self.groups.sender_key(group, sender)
+        try:
+            if cipher is None:
+                raise InvalidTag()
+            body = json.loads(cipher.open(header, nonce, ciphertext))
+        except InvalidTag:
+            self.send_secure(sender, json.dumps({"key_request": group}), ip=addr[0])
+            return None
+        self.send_secure(sender, json.dumps({"ack": body["id"]}), ip=addr[0])
+        if self.is_duplicate(sender, body["id"]):
+            return None
+        return f"#{group}", sender, body["text"]
+
+    # A member asked for our sender key for a group, after missing it or restarting
+    def resend_group_key(self, group, member):
+        cipher = self.groups.current_key(group)
+        if cipher is not None and member in self.groups.members(group):
+            self.distribute_group_key(group, cipher, [member])
+
+    # Decode stage of the receive pipeline, run on receive_pool
+    def decode_payload(self, data, addr):
+        try:
+            if data[:1] == bytes((GROUP_FRAME_VERSION,)):
+                return self.handle_group_frame(data, addr)
+            if data[:1] == bytes((FILE_FRAME_VERSION,)):
+                return self.handle_file_chunk(data, addr)
+            if data[:1] != b'{':
+                return self.handle_frame(data, addr)
+            data_json = json.loads(data.decode())
+            if data_json.get("type") == "handshake":
+                self.handle_handshake(data_json, addr)
+            elif "update_query" in data_json:
+                self.answer_update_query(data_json["update_query"], addr)
+            elif "update_request" in data_json:
+                asyncio.run_coroutine_threadsafe(self.serve_update(data_json["update_request"], addr), self.lan_transport.loop)
+        except Exception as e:
+            print(f"Error handling payload from {addr[0]}: {e}")
+        return None
+
+    # Handle a payload from the LAN transport that isn't a discovery beacon. Runs on the transport thread,
+    # so the work is handed straight to the receive pool
+    def handle_payload(self, data, addr):
+        try:
+            self.received.append(self.receive_pool.submit(self.decode_payload, data, addr))
+        except RuntimeError:
+            pass  # Pool already shut down while closing
 
     # Send a message
     def send_message(self):
-        recipient = simpledialog.askstring("Recipient", "Enter recipient username:")
+        recipient = simpledialog.askstring("Recipient", "Enter recipient username or #group:")
         if recipient:
             message = self.entry.get()
             self.entry.delete(0, tk.END)
 
-            if recipient in self.known_users:
-                # Send message over LAN (LAN message)
-                aes_key, encrypted_aes_key = self.get_session_key(recipient)
-                encrypted_message = encrypt_message_aes(aes_key, message)
-                send_lan_message(self.known_users[recipient], self.username, encrypted_message)
-                self.add_message(f"You to {recipient}: {message}")
-            else:
-                messagebox.showwarning("Warning", f"{recipient} not found in known users.")
+            if recipient.startswith("#"):
+                if recipient[1:] not in self.groups:
+                    messagebox.showerror("Error", f"There is no group called {recipient}.")
+                    return
+                delivery = self.send_group(recipient[1:], message)
+                self.record_messages([(recipient, self.username, message)], delivery)
+            elif recipient in self.known_users or messagebox.askyesno(
+                    "Recipient offline",
+                    f"{recipient} is not on the network right now. Queue the message until they are?"):
+                # Send message over LAN (LAN message); the outbox retries until it's acknowledged
+                message_id = self.outbox.enqueue(recipient, message)
+                self.record_messages([(recipient, self.username, message)], (message_id, 1))
 
     # Toggle theme between light and dark
     def toggle_theme(self):
@@ -245,13 +2224,23 @@ class MessagingApp:
             self.chat_window.config(bg="gray", fg="white")
             self.entry.config(bg="darkgray", fg="white")
             self.send_button.config(bg="gray", fg="white")
+            self.group_button.config(bg="gray", fg="white")
+            self.file_button.config(bg="gray", fg="white")
             self.toggle_button.config(bg="gray", fg="white")
+            self.search_frame.config(bg="black")
+            self.search_entry.config(bg="darkgray", fg="white")
+            self.search_button.config(bg="gray", fg="white")
         else:
             self.root.config(bg="white")
             self.chat_window.config(bg="white", fg="black")
             self.entry.config(bg="white", fg="black")
             self.send_button.config(bg="lightgray", fg="black")
+            self.group_button.config(bg="lightgray", fg="black")
+            self.file_button.config(bg="lightgray", fg="black")
             self.toggle_button.config(bg="lightgray", fg="black")
+            self.search_frame.config(bg="white")
+            self.search_entry.config(bg="white", fg="black")
+            self.search_button.config(bg="lightgray", fg="black")
 
 # Run the app
 if __name__ == "__main__":
@@ -1,17 +1,37 @@
 import os
+import asyncio
 import socket
 import subprocess
 import tkinter as tk
 from tkinter import scrolledtext, simpledialog, messagebox, ttk
-from threading import Thread
+from threading import Thread, Event, Lock, Condition
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import requests  # New import for making API calls
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import hashlib
 import time
 
 BROADCAST_PORT = 5555
 BUFFER_SIZE = 1024
 THEME_FILE = "theme_settings.json"  # File to store theme settings
-API_BASE_URL = "https://api.atdevs.org"  # Base URL for API
+PUBLIC_KEY_CACHE_FILE = "public_keys.json"  # Cached public keys and pinned fingerprints
+PUBLIC_KEY_TTL = 24 * 60 * 60  # Seconds before a cached public key is fetched again
+PUBLIC_KEY_CACHE_SIZE = 512  # Public keys kept in the cache; the least recently used is evicted first
+API_BASE_URL = os.environ.get("MSGAPP_API_URL", "https://api.atdevs.org")  # Base URL for API; point at api_stub_server.py for local testing
+API_TIMEOUT = (3.05, 10)  # Connect and read timeouts in seconds
+API_RETRIES = 3  # Retries for idempotent calls on connection errors and 502/503/504
+API_POOL_SIZE = 8  # Keep-alive connections kept open to the API host
+API_WORKERS = 4  # Threads running API calls off the Tk thread
+API_PUMP_INTERVAL = 50  # Milliseconds between handing finished API calls back to the GUI
+LONG_POLL_WAIT = 25  # Seconds the server may hold a receive request open waiting for messages
+POLL_FALLBACK_INTERVAL = 5  # Seconds between polls if the server answers immediately (no long-poll support)
+RECEIVE_RETRY_MAX = 60  # Max seconds between receive attempts while the API is unreachable
+BATCH_MAX_MESSAGES = 100  # Outgoing messages sent in one batch request at most
+BATCH_MAX_BYTES = 256 * 1024  # A batch is sent as soon as its message text reaches this size
+BATCH_FLUSH_INTERVAL = 0.05  # Seconds a message may wait for others to join its batch
 
 # Helper function to get the local IP address
 def get_local_ip():
@@ -51,44 +71,346 @@ def listen_for_broadcasts(known_users, local_username):
         except Exception as e:
             print(f"Error decoding broadcast: {e}")
 
+# API client wrapping a pooled keep-alive session, so calls reuse connections instead of paying for a
+# new TCP+TLS handshake each time. Every call has a timeout, and idempotent calls are retried
+class ApiClient:
+    def __init__(self, base_url=API_BASE_URL, timeout=API_TIMEOUT, retries=API_RETRIES, pool_size=API_POOL_SIZE):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(["GET", "PUT"]))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, path, **kwargs):
+        try:
+            return self.session.request(method, f"{self.base_url}{path}", timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            print(f"API request to {path} failed: {e}")
+            return None
+
+    # Register a new user
+    def register_user(self, username, password):
+        response = self.request("POST", "/user/register", json={"username": username, "password": password})
+        return response is not None and response.status_code == 200  # True if registration was successful
+
+    # Get the public key of a user
+    def get_public_key(self, username):
+        response = self.request("GET", f"/publickey/{username}")
+        return response.json() if response is not None and response.status_code == 200 else None
+
+    # Get the public keys of several users in one request; returns {username: key} for the users found.
+    # Falls back to one request per user against servers without the batch endpoint
+    def get_public_keys(self, usernames):
+        response = self.request("POST", "/publickey/batch", json={"usernames": list(usernames)})
+        if response is not None and response.status_code == 200:
+            return response.json()
+        if response is not None and response.status_code in (404, 405):
+            keys = {}
+            for username in usernames:
+                key = self.get_public_key(username)
+                if key is not None:
+                    keys[username] = key
+            return keys
+        return {}
+
+    # Send a message to a user
+    def send_message(self, from_user, to_user, message):
+        response = self.request("POST", "/message/send", json={"from": from_user, "to": to_user, "message": message})
+        return response is not None and response.status_code == 200  # True if message was sent successfully
+
+    # Send several messages in one request; each is a dict with from, to and message. Returns a list of
+    # booleans, one per message. Falls back to one request per message against servers without the batch endpoint
+    def send_messages(self, messages):
+        response = self.request("POST", "/message/send/batch", json={"messages": messages})
+        if response is not None and response.status_code == 200:
+            try:
+                results = response.json().get("results")
+            except (ValueError, AttributeError):
+                print("API batch send returned an unexpected response")
+                return [False] * len(messages)
+            if results is None:
+                return [True] * len(messages)
+            return results if isinstance(results, list) else [False] * len(messages)
+        if response is not None and response.status_code in (404, 405):
+            return [self.send_message(m["from"], m["to"], m["message"]) for m in messages]
+        return [False] * len(messages)
+
+    # Receive messages for a user. With wait > 0 the server holds the request open until a message newer
+    # than the since cursor arrives, or wait seconds pass
+    def receive_messages(self, username, since=None, wait=0):
+        params = {}
+        if since is not None:
+            params["since"] = since
+        if wait:
+            params["wait"] = wait
+        timeout = (self.timeout[0], self.timeout[1] + wait)
+        try:
+            response = self.session.get(f"{self.base_url}/message/receive/{username}", params=params, timeout=timeout)
+        except requests.RequestException as e:
+            print(f"API request to /message/receive failed: {e}")
+            return None
+        return response.json() if response.status_code == 200 else None
+
+    # Broadcast a message to all users
+    def broadcast_message(self):
+        response = self.request("GET", "/user/broadcast")
+        return response is not None and response.status_code == 200  # True if broadcast was successful
+
+    # Update user settings
+    def update_user_settings(self, username, theme):
+        response = self.request("PUT", "/user/settings", json={"username": username, "theme": theme})
+        return response is not None and response.status_code == 200  # True if settings were updated
+
+    def close(self):
+        self.session.close()
+
+# Asyncio front end for ApiClient. Calls run on a small thread pool that shares the client's pooled session
+class AsyncApiClient:
+    def __init__(self, client=None, workers=API_WORKERS):
+        self.client = client or ApiClient()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def call(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
+
+    async def register_user(self, username, password):
+        return await self.call(self.client.register_user, username, password)
+
+    async def get_public_key(self, username):
+        return await self.call(self.client.get_public_key, username)
+
+    async def get_public_keys(self, usernames):
+        return await self.call(self.client.get_public_keys, usernames)
+
+    async def send_message(self, from_user, to_user, message):
+        return await self.call(self.client.send_message, from_user, to_user, message)
+
+    async def send_messages(self, messages):
+        return await self.call(self.client.send_messages, messages)
+
+    async def receive_messages(self, username, since=None, wait=0):
+        return await self.call(self.client.receive_messages, username, since, wait)
+
+    async def broadcast_message(self):
+        return await self.call(self.client.broadcast_message)
+
+    async def update_user_settings(self, username, theme):
+        return await self.call(self.client.update_user_settings, username, theme)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.client.close()
+
+# Fingerprint of a public key as returned by the API
+def key_fingerprint(key):
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+# Local cache of other users' public keys: an in-memory LRU persisted to a JSON file, with a TTL so keys
+# are refreshed now and then. The first fingerprint seen for a user is pinned, and a different key
+# later is rejected instead of being silently trusted
+class PublicKeyCache:
+    def __init__(self, client, path=PUBLIC_KEY_CACHE_FILE, ttl=PUBLIC_KEY_TTL, max_entries=PUBLIC_KEY_CACHE_SIZE):
+        self.client = client
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # Username -> {"key": key, "fetched": time fetched}
+        self.pins = {}  # Username -> pinned fingerprint; never evicted
+        self.lock = Lock()
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                self.entries.update(data.get("keys", {}))
+                self.pins.update(data.get("pins", {}))
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable public key cache: {e}")
+
+    def get(self, username):
+        return self.get_many([username]).get(username)
+
+    # Resolve several usernames, fetching everything missing or stale in one batch request
+    def get_many(self, usernames):
+        now = time.time()
+        keys = {}
+        missing = []
+        with self.lock:
+            for username in usernames:
+                entry = self.entries.get(username)
+                if entry and now - entry["fetched"] < self.ttl:
+                    self.entries.move_to_end(username)
+                    keys[username] = entry["key"]
+                else:
+                    missing.append(username)
+        if missing:
+            fetched = self.client.get_public_keys(missing)
+            with self.lock:
+                for username, key in fetched.items():
+                    if self.store(username, key, now):
+                        keys[username] = key
+                self.save()
+        return keys
+
+    # Must be called with lock held
+    def store(self, username, key, now):
+        fingerprint = key_fingerprint(key)
+        pinned = self.pins.get(username)
+        if pinned and pinned != fingerprint:
+            print(f"Public key for {username} changed (pinned {pinned[:16]}, got {fingerprint[:16]}); rejecting it")
+            return False
+        self.pins[username] = fingerprint
+        self.entries[username] = {"key": key, "fetched": now}
+        self.entries.move_to_end(username)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return True
+
+    # Accept a user's new key after it has been verified out of band
+    def unpin(self, username):
+        with self.lock:
+            self.pins.pop(username, None)
+            self.entries.pop(username, None)
+            self.save()
+
+    # Must be called with lock held
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"keys": self.entries, "pins": self.pins}, f)
+        os.replace(tmp_path, self.path)
+
+api_client = ApiClient()  # Shared client used by the module-level helpers below
+public_key_cache = PublicKeyCache(api_client)
+
 # Register a new user
 def register_user(username, password):
-    url = f"{API_BASE_URL}/user/register"
-    payload = {"username": username, "password": password}
-    response = requests.post(url, json=payload)
-    return response.status_code == 200  # True if registration was successful
+    return api_client.register_user(username, password)
 
-# Get the public key of a user
+# Get the public key of a user, from the local cache when possible
 def get_public_key(username):
-    url = f"{API_BASE_URL}/publickey/{username}"
-    response = requests.get(url)
-    return response.json() if response.status_code == 200 else None
+    return public_key_cache.get(username)
+
+# Get the public keys of several users with at most one API request
+def get_public_keys(usernames):
+    return public_key_cache.get_many(usernames)
 
 # Send a message to a user
 def send_message_api(from_user, to_user, message):
-    url = f"{API_BASE_URL}/message/send"
-    payload = {"from": from_user, "to": to_user, "message": message}
-    response = requests.post(url, json=payload)
-    return response.status_code == 200  # True if message was sent successfully
+    return api_client.send_message(from_user, to_user, message)
+
+# Coalesces outgoing API messages into batch requests. A batch goes out once it's full or
+# flush_interval after its first message was queued, so a burst, or one message to many recipients,
+# costs one request instead of one per message
+class MessageBatcher:
+    def __init__(self, client, max_messages=BATCH_MAX_MESSAGES, max_bytes=BATCH_MAX_BYTES,
+                 flush_interval=BATCH_FLUSH_INTERVAL):
+        self.client = client
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.pending = []  # (message dict, callback)
+        self.pending_bytes = 0
+        self.first_queued = None
+        self.condition = Condition()
+        self.stopped = False
+
+    def start(self):
+        Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    # Queue a message; callback is called from the batcher thread with True or False once it's been sent
+    def send(self, from_user, to_user, message, callback=None):
+        with self.condition:
+            if not self.pending:
+                self.first_queued = time.monotonic()
+            self.pending.append(({"from": from_user, "to": to_user, "message": message}, callback))
+            self.pending_bytes += len(message)
+            self.condition.notify()
+
+    def full(self):
+        return len(self.pending) >= self.max_messages or self.pending_bytes >= self.max_bytes
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and not (self.pending and (
+                        self.full() or time.monotonic() - self.first_queued >= self.flush_interval)):
+                    timeout = None if not self.pending else self.first_queued + self.flush_interval - time.monotonic()
+                    self.condition.wait(timeout)
+                if self.stopped:
+                    return
+                batch = self.pending[:self.max_messages]
+                del self.pending[:self.max_messages]
+                self.pending_bytes = sum(len(message["message"]) for message, _ in self.pending)
+                self.first_queued = time.monotonic() if self.pending else None
+            try:
+                results = self.client.send_messages([message for message, _ in batch])
+            except Exception as e:
+                print(f"Error sending message batch: {e}")
+                results = []
+            # Messages the server didn't report on count as failed, so every callback still gets called
+            results = list(results)[:len(batch)] + [False] * (len(batch) - len(results))
+            for (message, callback), success in zip(batch, results):
+                if callback:
+                    try:
+                        callback(bool(success))
+                    except Exception as e:
+                        print(f"Error in message callback: {e}")
 
 # Receive messages for a user
-def receive_messages(username):
-    url = f"{API_BASE_URL}/message/receive/{username}"
-    response = requests.get(url)
-    return response.json() if response.status_code == 200 else None
+def receive_messages(username, since=None, wait=0):
+    return api_client.receive_messages(username, since, wait)
+
+# Background receiver that keeps one long-poll request open against the API and hands new messages to
+# on_messages as they arrive. Against a server without long-poll support it falls back to plain polling
+class MessageReceiver:
+    def __init__(self, client, username, on_messages, wait=LONG_POLL_WAIT):
+        self.client = client
+        self.username = username
+        self.on_messages = on_messages  # Called from the receiver thread with a list of message dicts
+        self.wait = wait
+        self.cursor = None  # Id of the last message received
+        self.stopped = Event()
+
+    def start(self):
+        Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        retry_delay = 1
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            result = self.client.receive_messages(self.username, since=self.cursor, wait=self.wait)
+            if result is None:
+                self.stopped.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, RECEIVE_RETRY_MAX)
+                continue
+            retry_delay = 1
+            # Long-poll servers answer {"messages": [...], "cursor": id}; older ones just a list
+            messages = result.get("messages", []) if isinstance(result, dict) else result
+            if isinstance(result, dict) and result.get("cursor") is not None:
+                self.cursor = result["cursor"]
+            if messages:
+                self.on_messages(messages)
+            elif time.monotonic() - started < 1:
+                self.stopped.wait(POLL_FALLBACK_INTERVAL)  # Server didn't hold the request open
 
 # Broadcast a message to all users
 def broadcast_message():
-    url = f"{API_BASE_URL}/user/broadcast"
-    response = requests.get(url)
-    return response.status_code == 200  # True if broadcast was successful
+    return api_client.broadcast_message()
 
 # Update user settings
 def update_user_settings(username, theme):
-    url = f"{API_BASE_URL}/user/settings"
-    payload = {"username": username, "theme": theme}
-    response = requests.put(url, json=payload)
-    return response.status_code == 200  # True if settings were updated
+    return api_client.update_user_settings(username, theme)
 
 # Start the update checker process
 def start_update_checker():
@@ -120,8 +442,16 @@ class MessagingApp:
         self.username = username
         self.known_users = {}  # Discovered users on LAN
         self.theme = load_theme_settings()["theme"]  # Load theme setting
+        self.api_executor = ThreadPoolExecutor(max_workers=API_WORKERS)
+        self.api_results = deque()  # (callback, result) pairs waiting to run on the Tk thread
+        self.receiver = MessageReceiver(api_client, self.username,
+                                        lambda messages: self.api_results.append((self.show_received, messages)))
+        self.batcher = MessageBatcher(api_client)
+        self.batcher.start()
         self.init_gui()
         self.start_broadcast_listener()
+        self.receiver.start()
+        self.root.after(API_PUMP_INTERVAL, self.pump_api_results)
 
     # Initialize GUI
     def init_gui(self):
@@ -147,8 +477,28 @@ class MessagingApp:
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
     def on_closing(self):
+        self.receiver.stop()
+        self.batcher.stop()
+        self.api_executor.shutdown(wait=False, cancel_futures=True)
+        api_client.close()
         self.root.quit()
 
+    # Run an API call off the Tk thread; callback gets the result back on the Tk thread
+    def run_api(self, callback, func, *args):
+        def finished(future):
+            if future.cancelled():
+                return
+            if future.exception():
+                print(f"API call failed: {future.exception()}")
+            self.api_results.append((callback, None if future.exception() else future.result()))
+        self.api_executor.submit(func, *args).add_done_callback(finished)
+
+    def pump_api_results(self):
+        while self.api_results:
+            callback, result = self.api_results.popleft()
+            callback(result)
+        self.root.after(API_PUMP_INTERVAL, self.pump_api_results)
+
     # Start a thread to broadcast username and listen for broadcasts
     def start_broadcast_listener(self):
         Thread(target=broadcast_username, args=(self.username,), daemon=True).start()
@@ -156,45 +506,70 @@ class MessagingApp:
 
     # Send a message
     def send_message(self):
-        recipient = simpledialog.askstring("Recipient", "Enter recipient username:")
-        if recipient:
+        recipients = simpledialog.askstring("Recipient", "Enter recipient username(s), separated by commas:")
+        recipients = [recipient.strip() for recipient in (recipients or "").split(",") if recipient.strip()]
+        if recipients:
             message = self.entry.get()
             self.entry.delete(0, tk.END)
 
-            if recipient in self.known_users:
-                # Send message over LAN
-                send_lan_message(self.known_users[recipient], self.username, message)
-                self.add_message(f"You to {recipient}: {message}")
-            else:
-                # Send message over the API
-                if send_message_api(self.username, recipient, message):
-                    self.add_message(f"You to {recipient} (API): {message}")
-                else:
-                    messagebox.showerror("Error", "Failed to send message via API.")
+            # Everyone goes through the API, users discovered on the LAN included: this client only
+            # discovers them, it has no LAN message channel (that's client_run.py's encrypted transport)
+            self.send_api_group(recipients, message)
+
+    # Send one message to several recipients over the API; the batcher puts them all in one request
+    def send_api_group(self, recipients, message):
+        results = {}
+
+        def sent(recipient, success):
+            results[recipient] = success
+            if len(results) < len(recipients):
+                return
+            delivered = [r for r in recipients if results[r]]
+            failed = [r for r in recipients if not results[r]]
+            if delivered:
+                self.add_message(f"You to {', '.join(delivered)} (API): {message}")
+            if failed:
+                messagebox.showerror("Error", f"Failed to send message via API to {', '.join(failed)}.")
+
+        for recipient in recipients:
+            self.batcher.send(self.username, recipient, message,
+                              lambda success, recipient=recipient: self.api_results.append(
+                                  (lambda success: sent(recipient, success), success)))
 
     def register(self):
         username = simpledialog.askstring("Register", "Enter a username:")
         password = simpledialog.askstring("Register", "Enter a password:", show='*')
         if username and password:
-            if register_user(username, password):
-                messagebox.showinfo("Success", "Registration successful!")
-                # Automatically get the public key after successful registration
-                public_key = get_public_key(username)
+            def got_public_key(public_key):
                 if public_key:
                     messagebox.showinfo("Public Key", f"Your public key: {public_key}")
                 else:
                     messagebox.showerror("Error", "Failed to retrieve public key.")
-            else:
-                messagebox.showerror("Error", "Registration failed. Username might be taken.")
+
+            def registered(success):
+                if success:
+                    messagebox.showinfo("Success", "Registration successful!")
+                    # Automatically get the public key after successful registration
+                    self.run_api(got_public_key, get_public_key, username)
+                else:
+                    messagebox.showerror("Error", "Registration failed. Username might be taken.")
+            self.run_api(registered, register_user, username, password)
 
     def update_settings(self):
         theme = simpledialog.askstring("Update Settings", "Enter new theme:")
         if theme:
-            if update_user_settings(self.username, theme):
-                messagebox.showinfo("Success", "Settings updated successfully!")
-                save_theme_settings(theme)  # Save the new theme
-            else:
-                messagebox.showerror("Error", "Failed to update settings.")
+            def updated(success):
+                if success:
+                    messagebox.showinfo("Success", "Settings updated successfully!")
+                    save_theme_settings(theme)  # Save the new theme
+                else:
+                    messagebox.showerror("Error", "Failed to update settings.")
+            self.run_api(updated, update_user_settings, self.username, theme)
+
+    # Show messages relayed through the API
+    def show_received(self, messages):
+        for message in messages:
+            self.add_message(f"{message.get('from')} (API): {message.get('message')}")
 
     # Add a message to the chat window
     def add_message(self, message):
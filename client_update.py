@@ -4,8 +4,18 @@ import requests
 import os
 import sys
 import hashlib
+import json
+import mmap
+import shutil
+import socket
+import struct
+import tempfile
+import time
 import asyncio
 import tkinter as tk
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
 
 # Configuration
 REPO_OWNER = 'AlextechYT'            # GitHub username
@@ -14,6 +24,37 @@ FILE_NAME_PY = 'client_run.py'       # The Python file to check for updates
 FILE_NAME_EXE = 'client_run.exe'     # The executable file to check for updates
 LOCAL_FILE_PY = os.path.join(os.getcwd(), FILE_NAME_PY)
 LOCAL_FILE_EXE = os.path.join(os.getcwd(), FILE_NAME_EXE)
+UPDATE_STATE_FILE = os.path.join(os.getcwd(), 'update_state.json')  # ETag and blob SHA from the last check
+GITHUB_API = 'https://api.github.com'
+# Where release files and their delta manifests (<file>.manifest.json) are served from
+UPDATE_BASE_URL = os.environ.get('MSGAPP_UPDATE_URL', f'https://raw.githubusercontent.com/{REPO_OWNER}/{REPO_NAME}/main')
+DELTA_UPDATES = True                 # Fetch only changed chunks when a manifest is published
+CDC_MIN_SIZE = 2 * 1024              # Content-defined chunk size limits; must match the published manifests
+CDC_MAX_SIZE = 64 * 1024
+CDC_MASK = ((1 << 13) - 1) << 51     # 13 bits, so chunks average about 8 KiB past the minimum
+RANGE_MERGE_GAP = 16 * 1024          # Missing chunks closer than this are fetched in one range request
+UPDATE_CACHE_DIR = os.path.join(os.getcwd(), 'update_cache')  # Verified update files named by hash, shared with LAN peers
+UPDATE_CACHE_FILES = 4               # Cached update files kept; the oldest are removed first
+UPDATE_FROM_PEERS = True             # Ask clients on the LAN for an update before going to the origin
+LAN_PORT = 5555                      # Port client_run.py listens on for discovery and streams
+MULTICAST_GROUP = '239.255.55.55'    # client_run.py discovery group
+PEER_QUERY_WAIT = 1.5                # Seconds to wait for a LAN peer to offer an update
+PEER_TIMEOUT = 10                    # Socket timeout while downloading from a LAN peer
+MAX_FRAME_SIZE = 16 * 1024 * 1024    # Largest stream frame accepted from a peer
+FRAME_HEADER = struct.Struct('!I')   # Length prefix of client_run.py stream frames
+CHUNK_SIZE = 64 * 1024               # Bytes hashed or downloaded at a time
+REQUEST_TIMEOUT = (5, 30)            # Connect and read timeouts in seconds
+UPDATE_INTERVAL = int(os.environ.get('MSGAPP_UPDATE_INTERVAL', 60))  # Seconds between retries after a failed update
+UPDATE_CHECK_TIMEOUT = 300           # Seconds one check, including any download, may take before it's abandoned
+GUI_POLL_INTERVAL = 100              # Milliseconds between applying updates queued for the window
+
+session = requests.Session()         # Reuses the connection to GitHub across checks
+workers = ThreadPoolExecutor()       # Runs the blocking parts of update checks
+running = set()                      # Futures of work submitted to workers that hasn't finished
+
+# Random-looking 64-bit value per byte for the gear rolling hash; derived from SHA-256 so every client
+# and the manifest generator agree on it
+GEAR = [int.from_bytes(hashlib.sha256(bytes((i,))).digest()[:8], 'big') for i in range(256)]
 
 class UpdaterGUI:
     def __init__(self):
@@ -31,73 +72,391 @@ class UpdaterGUI:
         self.root.geometry("400x150")  # Width x Height
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
+        # The update checks run on an asyncio loop in a background thread; anything they do to the window
+        # is queued here and applied on the Tk thread
+        self.pending = deque()
+        self.loop = None
+        self.task = None
+
     def on_closing(self):
+        self.cancel()
         self.root.quit()
 
+    # Cancel the running update check; safe to call from any thread
+    def cancel(self):
+        if self.task:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+
+    # Run func on the Tk thread; safe to call from any thread
+    def call(self, func, *args):
+        self.pending.append((func, args))
+
+    def process_pending(self):
+        while self.pending:
+            func, args = self.pending.popleft()
+            func(*args)
+        self.root.after(GUI_POLL_INTERVAL, self.process_pending)
+
     def show_error(self, message):
-        self.error_label.config(text=message)
+        self.call(self.error_label.config, {'text': message})
 
     def update_status(self, message):
-        self.status_label.config(text=message)
+        self.call(self.status_label.config, {'text': message})
+
+    def run_updates(self):
+        asyncio.run(self.updates())
+
+    async def updates(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        try:
+            await update_loop(self)
+        except asyncio.CancelledError:
+            pass
 
     def run(self):
+        Thread(target=self.run_updates, daemon=True).start()
+        self.root.after(GUI_POLL_INTERVAL, self.process_pending)
         self.root.mainloop()
 
-# Get the download URL for the file
-async def get_download_url(gui):
-    url = f'https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/contents/{FILE_NAME_PY}'
-    gui.update_status("Fetching download URL...")
-    response = await loop.run_in_executor(None, requests.get, url)
-    if response.status_code == 200:
-        content = response.json()
-        gui.update_status("Download URL fetched successfully.")
-        return content['download_url']  # Get the raw URL for downloading
-    else:
+# Load the ETag and blob SHA recorded by the last update check
+def load_update_state():
+    if os.path.exists(UPDATE_STATE_FILE):
+        with open(UPDATE_STATE_FILE, 'r') as f:
+            return json.load(f)
+    return {}
+
+def save_update_state(state):
+    with open(UPDATE_STATE_FILE, 'w') as f:
+        json.dump(state, f)
+
+# Ask the Contents API whether client_run.py has changed. Returns (download URL, blob SHA, size) if an
+# update is needed, otherwise None. The request carries the ETag from the last check, so an unchanged
+# file costs a 304 with no body, and a changed one is compared by blob SHA before anything is downloaded
+async def check_for_update(gui):
+    url = f'{GITHUB_API}/repos/{REPO_OWNER}/{REPO_NAME}/contents/{FILE_NAME_PY}'
+    gui.update_status("Checking for updates...")
+    state = load_update_state()
+    local_sha = await run_worker(calculate_blob_sha, LOCAL_FILE_PY)
+    headers = {}
+    if state.get('etag') and state.get('blob_sha') == local_sha:
+        headers['If-None-Match'] = state['etag']  # Only valid while the local file is the one we last saw
+    try:
+        response = await run_worker(
+            lambda: session.get(url, headers=headers, timeout=REQUEST_TIMEOUT))
+    except requests.RequestException as e:
+        gui.show_error(f"Error checking for updates: {e}")
+        return None
+    if response.status_code == 304:
+        await run_worker(store_in_cache, LOCAL_FILE_PY, local_sha)
+        return None
+    if response.status_code != 200:
         gui.show_error(f"Error fetching download URL: {response.status_code}")  # Show response code in GUI
-    return None
+        return None
+    content = response.json()
+    state.update(etag=response.headers.get('ETag'), blob_sha=content['sha'])
+    save_update_state(state)
+    print(f"Local file SHA: {local_sha}")
+    print(f"Server file SHA: {content['sha']}")
+    if content['sha'] == local_sha:
+        await run_worker(store_in_cache, LOCAL_FILE_PY, local_sha)
+        return None
+    return content['download_url'], content['sha'], content['size']
 
-# Download the updated file
-async def download_file(download_url, gui):
+# Download the update from the cache or a LAN peer if one has it, else in a single streamed request
+async def download_file(download_url, blob_sha, size, gui):
     gui.update_status("Downloading the update...")
-    response = await loop.run_in_executor(None, requests.get, download_url)
-    if response.status_code == 200:
-        with open(FILE_NAME_PY, 'wb') as f:
-            f.write(response.content)
+    if await run_worker(fetch_cached, blob_sha, size, LOCAL_FILE_PY):
         gui.update_status("Update downloaded successfully.")
         return True
-    else:
-        gui.show_error(f"Error downloading file: {response.status_code}")  # Show response code in GUI
-    return False
-
-# Calculate SHA-256 hash of a file
-def calculate_hash(file_path):
-    if os.path.exists(file_path):
-        with open(file_path, 'rb') as f:
-            return hashlib.sha256(f.read()).hexdigest()
-    return None
-
-# Verify the downloaded file using SHA-256
-async def verify_update(gui):
-    gui.update_status("Verifying update...")
-    # Get the hash of the current local file
-    local_hash = calculate_hash(LOCAL_FILE_PY) if os.path.exists(LOCAL_FILE_PY) else None
-    
-    # Get the hash of the server file
-    download_url = await get_download_url(gui)
-    if download_url:
-        response = await loop.run_in_executor(None, requests.get, download_url)
-        if response.status_code == 200:
-            server_file_hash = hashlib.sha256(response.content).hexdigest()
-            print(f"Local file hash: {local_hash}")
-            print(f"Server file hash: {server_file_hash}")
-
-            # Compare hashes
-            if local_hash != server_file_hash:
-                gui.update_status("Update needed. Downloading...")
-                return True  # Indicates an update is needed
+    try:
+        verified = await run_worker(fetch_file, download_url, blob_sha, LOCAL_FILE_PY)
+    except (requests.RequestException, OSError) as e:
+        gui.show_error(f"Error downloading file: {e}")
+        return False
+    if not verified:
+        gui.show_error("Downloaded file does not match the server's hash.")
+        return False
+    await run_worker(store_in_cache, LOCAL_FILE_PY, blob_sha)
+    gui.update_status("Update downloaded successfully.")
+    return True
+
+# Stream a file to a temporary file next to path and rename it into place only if what was written
+# matches the expected blob SHA, so a failed download never leaves a half-written client
+def fetch_file(url, blob_sha, path):
+    f, temp_path = temp_file_for(path)
+    try:
+        with f, session.get(url, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+        if calculate_blob_sha(temp_path) != blob_sha:
+            return False
+        os.replace(temp_path, path)
+        return True
+    finally:
+        remove_temp_file(temp_path)
+
+# A new temporary file in the same directory as path, so it can be renamed over it, as (open file, path).
+# Every attempt gets its own, since one that timed out may still be writing to its file
+def temp_file_for(path, suffix='.download'):
+    fd, temp_path = tempfile.mkstemp(suffix=suffix, prefix=os.path.basename(path) + '.',
+                                     dir=os.path.dirname(os.path.abspath(path)))
+    return os.fdopen(fd, 'wb'), temp_path
+
+# Delete a temporary file unless it has already been renamed into place
+def remove_temp_file(temp_path):
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+# Calculate the hash of a file (SHA-256 unless another digest is passed in), reading it in chunks
+def calculate_hash(file_path, digest=None):
+    if not os.path.exists(file_path):
+        return None
+    digest = digest or hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Git blob SHA-1 of a file, which is what the Contents API reports for the server copy
+def calculate_blob_sha(file_path):
+    if not os.path.exists(file_path):
+        return None
+    return calculate_hash(file_path, hashlib.sha1(b'blob %d\0' % os.path.getsize(file_path)))
+
+# Split data into content-defined chunks with a gear rolling hash, as (offset, size) pairs. Boundaries
+# depend only on nearby bytes, so an edit only changes the chunks around it and the rest still match
+def content_defined_chunks(data):
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = min(start + CDC_MAX_SIZE, len(data))
+        cut = end
+        h = 0
+        for offset, byte in enumerate(data[start + CDC_MIN_SIZE:end]):
+            h = ((h << 1) + GEAR[byte]) & 0xFFFFFFFFFFFFFFFF
+            if not h & CDC_MASK:
+                cut = start + CDC_MIN_SIZE + offset + 1
+                break
+        chunks.append((start, cut - start))
+        start = cut
+    return chunks
+
+# Describe a release file: its size, SHA-256 and the SHA-256 of each content-defined chunk
+def make_manifest(file_path):
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    chunks = [[offset, size, hashlib.sha256(data[offset:offset + size]).hexdigest()]
+              for offset, size in content_defined_chunks(data)]
+    return {'file': os.path.basename(file_path), 'size': len(data),
+            'sha256': hashlib.sha256(data).hexdigest(), 'chunks': chunks}
+
+# Group the chunks we lack into byte ranges of the release file, merging ones that are close together
+def missing_ranges(chunks, have):
+    ranges = []
+    for offset, size, digest in chunks:
+        if digest in have:
+            continue
+        if ranges and offset - ranges[-1][1] <= RANGE_MERGE_GAP:
+            ranges[-1][1] = offset + size
         else:
-            gui.show_error(f"Error verifying update: {response.status_code}")  # Show response code in GUI
-    return False  # No update needed
+            ranges.append([offset, offset + size])
+    return ranges
+
+# Rebuild the release file from the chunks of the local file it shares plus the byte ranges it doesn't,
+# fetched with HTTP range requests, and rename it into place if its SHA-256 matches the manifest.
+# Returns the number of bytes downloaded, or None if the result didn't verify
+def apply_delta(manifest, url, path):
+    fetched = 0
+    f, temp_path = temp_file_for(path)
+    try:
+        with f, open(path, 'rb') as local, mmap.mmap(local.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            have = {}
+            for offset, size in content_defined_chunks(data):
+                have.setdefault(hashlib.sha256(data[offset:offset + size]).hexdigest(), offset)
+            f.truncate(manifest['size'])
+            for offset, size, digest in manifest['chunks']:
+                if digest in have:
+                    f.seek(offset)
+                    f.write(data[have[digest]:have[digest] + size])
+            for start, end in missing_ranges(manifest['chunks'], have):
+                headers = {'Range': f'bytes={start}-{end - 1}', 'Accept-Encoding': 'identity'}
+                with session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        start = 0  # Server ignored the range and is sending the whole file
+                    f.seek(start)
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        fetched += len(chunk)
+                if response.status_code != 206:
+                    break
+        if calculate_hash(temp_path) != manifest['sha256']:
+            return None
+        os.replace(temp_path, path)
+        return fetched
+    finally:
+        remove_temp_file(temp_path)
+
+# Update the client (the .exe if there is one, else the .py) from its delta manifest. Returns "installed",
+# "current" or "failed", or None if no manifest is published for it, in which case the whole-file check is
+# used instead. Like the whole-file check, the manifest is fetched conditionally on its ETag
+async def delta_update(gui):
+    target = LOCAL_FILE_EXE if os.path.exists(LOCAL_FILE_EXE) else LOCAL_FILE_PY
+    name = os.path.basename(target)
+    if not os.path.exists(target) or os.path.getsize(target) == 0:
+        return None
+    gui.update_status("Checking for updates...")
+    state = load_update_state()
+    local_hash = await run_worker(calculate_hash, target)
+    headers = {}
+    if state.get('manifest_etag') and state.get('manifest_sha256') == local_hash:
+        headers['If-None-Match'] = state['manifest_etag']
+    try:
+        response = await run_worker(
+            lambda: session.get(f'{UPDATE_BASE_URL}/{name}.manifest.json', headers=headers, timeout=REQUEST_TIMEOUT))
+    except requests.RequestException:
+        return None
+    if response.status_code == 304:
+        await run_worker(store_in_cache, target, local_hash)
+        return "current"
+    if response.status_code != 200:
+        return None
+    manifest = response.json()
+    state.update(manifest_etag=response.headers.get('ETag'), manifest_sha256=manifest['sha256'])
+    save_update_state(state)
+    if manifest['sha256'] == local_hash:
+        await run_worker(store_in_cache, target, local_hash)
+        return "current"
+    gui.update_status("Update needed. Downloading...")
+    if await run_worker(fetch_cached, manifest['sha256'], manifest['size'], target):
+        return "installed"
+    gui.update_status("Update needed. Downloading changes...")
+    try:
+        fetched = await run_worker(apply_delta, manifest, f'{UPDATE_BASE_URL}/{name}', target)
+    except (requests.RequestException, OSError, ValueError) as e:
+        gui.show_error(f"Error downloading update: {e}")
+        return "failed"
+    if fetched is None:
+        gui.show_error("Downloaded file does not match the server's hash.")
+        return "failed"
+    print(f"Fetched {fetched} of {manifest['size']} bytes for {name}")
+    await run_worker(store_in_cache, target, manifest['sha256'])
+    return "installed"
+
+# Check a file against a cache key: a SHA-256 from a delta manifest or a git blob SHA-1 from the Contents API
+def verify_artifact(file_path, key):
+    if len(key) == 64:
+        return calculate_hash(file_path) == key
+    return calculate_blob_sha(file_path) == key
+
+def cache_path(key):
+    return os.path.join(UPDATE_CACHE_DIR, key)
+
+# Keep a verified update file in the cache so LAN peers (and later installs) can get it from us
+def store_in_cache(file_path, key):
+    path = cache_path(key)
+    if os.path.exists(path) or not os.path.exists(file_path):
+        return
+    os.makedirs(UPDATE_CACHE_DIR, exist_ok=True)
+    f, temp_path = temp_file_for(path, suffix='.tmp')
+    try:
+        with f, open(file_path, 'rb') as source:
+            shutil.copyfileobj(source, f)
+        os.replace(temp_path, path)
+    finally:
+        remove_temp_file(temp_path)
+    cached = sorted((os.path.join(UPDATE_CACHE_DIR, name) for name in os.listdir(UPDATE_CACHE_DIR)
+                     if not name.endswith('.tmp')), key=os.path.getmtime)
+    for old in cached[:-UPDATE_CACHE_FILES]:
+        os.remove(old)
+
+# Put the update file with this key (and size, as the origin gave it) at path, from the cache or a LAN
+# peer, without touching the origin. Returns True if path now holds the verified file
+def fetch_cached(key, size, file_path):
+    f, temp_path = temp_file_for(file_path)
+    try:
+        with f:
+            cached = os.path.exists(cache_path(key))
+            if cached:
+                with open(cache_path(key), 'rb') as source:
+                    shutil.copyfileobj(source, f)
+        if not (cached or UPDATE_FROM_PEERS and fetch_from_peers(key, size, temp_path)):
+            return False
+        if not verify_artifact(temp_path, key):
+            return False
+        os.replace(temp_path, file_path)
+    finally:
+        remove_temp_file(temp_path)
+    store_in_cache(file_path, key)
+    return True
+
+# Ask the clients on the LAN, through the discovery port, which of them has the file cached, and download
+# it from the first one that answers. Returns True if something was downloaded; the caller verifies it
+def fetch_from_peers(key, size, file_path):
+    query = json.dumps({'update_query': key}).encode()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        for addr in ((MULTICAST_GROUP, LAN_PORT), ('<broadcast>', LAN_PORT)):
+            try:
+                sock.sendto(query, addr)
+            except OSError:
+                pass
+        deadline = time.monotonic() + PEER_QUERY_WAIT
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            sock.settimeout(remaining)
+            try:
+                data, addr = sock.recvfrom(1024)
+                if json.loads(data).get('update_offer') == key:
+                    break
+            except socket.timeout:
+                return False
+            except ValueError:
+                continue
+    print(f"Downloading update from LAN peer {addr[0]}")
+    try:
+        return download_from_peer(addr[0], key, size, file_path)
+    except (OSError, ValueError) as e:
+        print(f"Error downloading update from {addr[0]}: {e}")
+        return False
+
+# Request a cached update file over a stream connection to a peer's client and write it to file_path. The
+# peer isn't trusted for the size either: it must match what the origin said, and nothing past it is written
+def download_from_peer(ip, key, size, file_path):
+    with socket.create_connection((ip, LAN_PORT), timeout=PEER_TIMEOUT) as conn:
+        request = json.dumps({'update_request': key}).encode()
+        conn.sendall(FRAME_HEADER.pack(len(request)) + request)
+        header = json.loads(read_frame(conn))
+        if header.get('update_offer') != key or header.get('size') != size:
+            raise ValueError("Unexpected answer from peer")
+        received = 0
+        with open(file_path, 'wb') as f:
+            while received < size:
+                chunk = read_frame(conn)
+                received += len(chunk)
+                if received > size:
+                    raise ValueError("Peer sent more than the file")
+                f.write(chunk)
+    return True
+
+def read_frame(conn):
+    (length,) = FRAME_HEADER.unpack(read_exactly(conn, FRAME_HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError("Frame from peer is too large")
+    return read_exactly(conn, length)
+
+def read_exactly(conn, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(min(size - len(data), CHUNK_SIZE))
+        if not chunk:
+            raise ConnectionError("Peer closed the connection")
+        data += chunk
+    return bytes(data)
 
 # Restart the main client
 def restart_client():
@@ -107,40 +466,68 @@ def restart_client():
     else:
         os.execv(sys.executable, ['python'] + [FILE_NAME_PY])
 
+# Check for an update and install it; returns "installed", "current" or "failed"
+async def check_and_install(gui):
+    status = await delta_update(gui) if DELTA_UPDATES else None
+    if status is None:
+        update = await check_for_update(gui)
+        if update:
+            gui.update_status("Update needed. Downloading...")
+            status = "installed" if await download_file(*update, gui) else "failed"
+        else:
+            status = "current"
+    return status
+
+# Run blocking work for an update check on workers, like asyncio.to_thread but tracked in running: a check
+# that times out is abandoned, but the thread it was waiting on carries on
+async def run_worker(func, *args):
+    future = workers.submit(func, *args)
+    running.add(future)
+    future.add_done_callback(running.discard)
+    return await asyncio.wrap_future(future)
+
+# Runs on the updater's asyncio thread. The client is restarted on the Tk thread once it's up to date;
+# a failed or timed out check is retried every UPDATE_INTERVAL seconds, once the work the last one left
+# behind has finished, so two attempts never write the client or the cache at the same time
 async def update_loop(gui):
     while True:
+        if running:
+            print("Waiting for the last update check to finish...")
+            await asyncio.gather(*(asyncio.wrap_future(future) for future in list(running)), return_exceptions=True)
         print("Checking for updates...")
         gui.update_status("Checking for updates...")
-        
-        if await verify_update(gui):
-            download_url = await get_download_url(gui)
-            if download_url:
-                if await download_file(download_url, gui):
-                    print("Update installed.")
-                    gui.update_status("Update installed. Restarting client...")
-                    restart_client()
-                else:
-                    print("Failed to download the update.")
-                    gui.update_status("Failed to download the update.")
+
+        try:
+            status = await asyncio.wait_for(check_and_install(gui), UPDATE_CHECK_TIMEOUT)
+        except asyncio.TimeoutError:
+            gui.show_error("Update check timed out.")
+            status = "failed"
+        if status == "installed":
+            print("Update installed.")
+            gui.update_status("Update installed. Restarting client...")
+            gui.call(restart_client)
+            return
+        elif status == "failed":
+            print("Failed to download the update.")
+            gui.update_status("Failed to download the update.")
         else:
             print("No updates needed. Starting client.")
             gui.update_status("No updates needed. Starting client.")
-            restart_client()
+            gui.call(restart_client)
+            return
 
-        await asyncio.sleep(60)  # Wait before checking again
+        await asyncio.sleep(UPDATE_INTERVAL)  # Wait before checking again
 
 if __name__ == '__main__':
-    gui = UpdaterGUI()
+    # Publishing a release: python client_update.py --make-manifest client_run.py client_run.exe
+    if len(sys.argv) > 2 and sys.argv[1] == '--make-manifest':
+        for file_path in sys.argv[2:]:
+            with open(file_path + '.manifest.json', 'w') as f:
+                json.dump(make_manifest(file_path), f)
+            print(f"Wrote {file_path}.manifest.json")
+        sys.exit()
 
-    # Create a new event loop and set it as the current one
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+    gui = UpdaterGUI()
 
-    # Start the update loop in a separate task
-    loop.create_task(update_loop(gui))
-    
-    # Run the GUI in the main thread
+    # Run the GUI in the main thread; the update checks start alongside it on their own thread
     gui.run()
-
-    # Start the event loop
-    loop.run_forever()
@@ -1,30 +1,137 @@
 import os
+import hashlib
+import time
 import platform
 import requests
 import struct
 import tkinter as tk
-from tkinter import filedialog, messagebox
+from tkinter import filedialog, messagebox, ttk
 from pathlib import Path
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 
 # Constants for GitHub URLs
 BASE_URL = "https://github.com/AlextechYT/msgapp/raw/main/"
 FILES = ["client_run.py", "client_update.py"]  # Files to download
-
+DOWNLOAD_WORKERS = 4  # Files downloaded at the same time
+DOWNLOAD_RETRIES = 5  # Attempts per file; each one resumes where the last stopped
+CHUNK_SIZE = 64 * 1024  # Bytes written or hashed at a time
+REQUEST_TIMEOUT = (5, 30)  # Connect and read timeouts in seconds
+PROGRESS_INTERVAL = 100  # Milliseconds between progress bar updates
+
+session = requests.Session()
+download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+progress = {}  # File name -> [bytes downloaded, total bytes or None], updated by the download threads
+progress_lock = Lock()
+
+# Download a file to save_path on a download thread. Data is streamed into a .part file, each retry
+# resumes it with a range request, and the result is checked against the file's release manifest (if
+# one is published) before it's renamed into place. Raises if the file can't be downloaded
 def download_file(url, save_path):
+    part_path = str(save_path) + '.part'
+    manifest = fetch_manifest(url)
+    for attempt in range(DOWNLOAD_RETRIES):
+        try:
+            fetch_part(url, part_path, save_path.name)
+            break
+        except requests.RequestException as e:
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise
+            print(f"Retrying {url} after error: {e}")
+            time.sleep(2 ** attempt)
+    if manifest and calculate_hash(part_path) != manifest['sha256']:
+        discard_part(part_path)  # Don't resume from bad data next time
+        raise ValueError("downloaded file does not match the release manifest")
+    os.replace(part_path, save_path)
+    discard_part(part_path)
+
+# Append the rest of a file to its .part file, asking only for the bytes we don't have yet. The file's
+# validator (ETag or Last-Modified) is kept next to the .part file and sent as If-Range, so if the release
+# changed in between the server sends the whole new file instead of the rest of it; a .part file with no
+# validator is never resumed
+def fetch_part(url, part_path, name):
+    validator_path = part_path + '.etag'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    validator = None
+    if offset and os.path.exists(validator_path):
+        with open(validator_path) as file:
+            validator = file.read()
+    headers = {'Accept-Encoding': 'identity'}  # Byte ranges and sizes refer to the file as stored
+    if validator:
+        headers['Range'] = f'bytes={offset}-'
+        headers['If-Range'] = validator
+    with session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        if response.status_code == 416 and validator:
+            return  # The .part file is already complete
+        response.raise_for_status()
+        if response.status_code == 206 and get_validator(response) != validator:
+            # Server ignored If-Range and sent part of a different file
+            discard_part(part_path)
+            raise requests.RequestException(f"{name} changed while it was being downloaded")
+        if response.status_code != 206:
+            offset = 0  # Server sent the whole file; start over
+            if get_validator(response):
+                with open(validator_path, 'w') as file:
+                    file.write(get_validator(response))
+            elif os.path.exists(validator_path):
+                os.remove(validator_path)
+        length = response.headers.get('Content-Length')
+        total = offset + int(length) if length else None
+        set_progress(name, offset, total)
+        with open(part_path, 'ab' if offset else 'wb') as file:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                file.write(chunk)
+                offset += len(chunk)
+                set_progress(name, offset, total)
+
+# Strong validator for a response: its ETag, unless it's weak (which If-Range can't use), else Last-Modified
+def get_validator(response):
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+# Delete a .part file and its validator
+def discard_part(part_path):
+    for path in (part_path, part_path + '.etag'):
+        if os.path.exists(path):
+            os.remove(path)
+
+# The release manifest published next to a file (see client_update.py --make-manifest), or None
+def fetch_manifest(url):
     try:
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an error for bad responses
-        with open(save_path, 'wb') as file:
-            file.write(response.content)
-    except Exception as e:
-        show_error(f"Failed to download {url}: {str(e)}")
+        response = session.get(url + '.manifest.json', timeout=REQUEST_TIMEOUT)
+    except requests.RequestException:
+        return None
+    return response.json() if response.status_code == 200 else None
+
+def calculate_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def set_progress(name, done, total):
+    with progress_lock:
+        progress[name] = [done, total]
+
+# Show overall download progress; called on the Tk thread
+def update_progress():
+    with progress_lock:
+        done = sum(entry[0] for entry in progress.values())
+        total = sum(entry[1] or entry[0] for entry in progress.values())
+    progress_bar['value'] = 100 * done / total if total else 0
+    label_progress.config(text=f"Downloaded {done // 1024} of {total // 1024} KiB")
 
 def install_files(install_directory, file_type, icon_path, create_shortcut_flag):
     install_path = Path(install_directory)
     install_path.mkdir(parents=True, exist_ok=True)
 
-    # Download the required files
+    # Download the required files in parallel; the window stays responsive and shows progress meanwhile
+    progress.clear()
+    downloads = {}
     for file_name in FILES:
         if file_type == 'exe' and file_name == "client_run.py":
             file_name = "client_run.exe"
@@ -33,7 +140,23 @@ def install_files(install_directory, file_type, icon_path, create_shortcut_flag)
 
         file_url = f"{BASE_URL}{file_name}"
         print(f"Downloading {file_name}...")
-        download_file(file_url, install_path / file_name)
+        downloads[download_pool.submit(download_file, file_url, install_path / file_name)] = file_name
+
+    button_install.config(state=tk.DISABLED)
+    root.after(PROGRESS_INTERVAL, wait_for_downloads, downloads, install_path, file_type, icon_path, create_shortcut_flag)
+
+# Poll the downloads from the Tk thread and finish the installation once they're all done
+def wait_for_downloads(downloads, install_path, file_type, icon_path, create_shortcut_flag):
+    update_progress()
+    if not all(future.done() for future in downloads):
+        root.after(PROGRESS_INTERVAL, wait_for_downloads, downloads, install_path, file_type, icon_path, create_shortcut_flag)
+        return
+    button_install.config(state=tk.NORMAL)
+    failed = [f"{file_name}: {future.exception()}" for future, file_name in downloads.items() if future.exception()]
+    if failed:
+        show_error("Failed to download:\n" + "\n".join(failed) + "\n\nClick Install again to resume.")
+        return
+    for file_name in downloads.values():
         print(f"{file_name} downloaded successfully!")
 
     # Write the selected theme to a file
@@ -161,6 +284,7 @@ def toggle_theme():
         for widget in frame_icon.winfo_children():
             widget.config(bg="black", fg="white")
         button_install.config(bg="gray", fg="white")
+        label_progress.config(bg="black", fg="white")
     else:
         root.config(bg="white")
         label_directory.config(bg="white", fg="black")
@@ -173,6 +297,7 @@ def toggle_theme():
         for widget in frame_icon.winfo_children():
             widget.config(bg="white", fg="black")
         button_install.config(bg="lightgray", fg="black")
+        label_progress.config(bg="white", fg="black")
 
 # Create the GUI
 root = tk.Tk()
@@ -232,6 +357,12 @@ checkbox_shortcut.pack(pady=10)
 button_install = tk.Button(root, text="Install", command=on_install)
 button_install.pack(pady=20)
 
+# Download progress
+progress_bar = ttk.Progressbar(root, length=300, maximum=100)
+progress_bar.pack(pady=5)
+label_progress = tk.Label(root, text="")
+label_progress.pack(pady=5)
+
 toggle_theme()  # Initialize with the correct theme
 
 root.mainloop()
@@ -0,0 +1,34 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import api_stub_server
+
+
+# Import one of the app scripts as a module; their file names aren't all valid module names
+def load_script(file_name):
+    name = os.path.splitext(file_name)[0].replace("-", "_")
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, file_name))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[name] = module
+    return sys.modules[name]
+
+
+# The stub API server on a free port, with empty state; yields its base URL
+@pytest.fixture
+def stub_server():
+    with api_stub_server.state_lock:
+        api_stub_server.users.clear()
+        api_stub_server.settings.clear()
+        api_stub_server.mailboxes.clear()
+    server = api_stub_server.start_stub_server(0)
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,99 @@
+import threading
+
+from conftest import load_script
+
+api = load_script("client_run_api-and-lan-msging.py")
+
+
+def test_register_send_and_receive(stub_server):
+    client = api.ApiClient(base_url=stub_server)
+    assert client.register_user("alice", "secret")
+    assert not client.register_user("alice", "secret")
+    assert client.send_message("bob", "alice", "hello")
+    result = client.receive_messages("alice")
+    assert [m["message"] for m in result["messages"]] == ["hello"]
+    assert client.receive_messages("alice", since=result["cursor"])["messages"] == []
+    client.close()
+
+
+def test_public_keys_in_one_batch(stub_server):
+    client = api.ApiClient(base_url=stub_server)
+    client.register_user("alice", "secret")
+    client.register_user("bob", "secret")
+    keys = client.get_public_keys(["alice", "bob", "nobody"])
+    assert sorted(keys) == ["alice", "bob"]
+    client.close()
+
+
+def test_send_messages_batch(stub_server):
+    client = api.ApiClient(base_url=stub_server)
+    messages = [{"from": "alice", "to": to, "message": "hi"} for to in ("bob", "carol")]
+    assert client.send_messages(messages) == [True, True]
+    assert client.receive_messages("carol")["messages"][0]["from"] == "alice"
+    client.close()
+
+
+def test_message_receiver_long_polls(stub_server):
+    client = api.ApiClient(base_url=stub_server)
+    received = []
+    arrived = threading.Event()
+
+    def on_messages(messages):
+        received.extend(m["message"] for m in messages)
+        if len(received) >= 2:
+            arrived.set()
+
+    receiver = api.MessageReceiver(client, "bob", on_messages, wait=5)
+    receiver.start()
+    client.send_message("alice", "bob", "one")
+    client.send_message("alice", "bob", "two")
+    assert arrived.wait(10)
+    receiver.stop()
+    assert received == ["one", "two"]
+
+
+def test_batcher_survives_failed_batch():
+    class FailingClient:
+        calls = 0
+
+        def send_messages(self, messages):
+            self.calls += 1
+            if self.calls == 1:
+                raise ValueError("not JSON")
+            return [True]  # Shorter than the batch
+
+    batcher = api.MessageBatcher(FailingClient(), max_messages=2, flush_interval=60)
+    batcher.start()
+    results = []
+    done = threading.Event()
+
+    def callback(success):
+        results.append(success)
+        if len(results) == 4:
+            done.set()
+
+    for to in ("bob", "carol", "bob", "carol"):
+        batcher.send("alice", to, "hi", callback)
+    assert done.wait(5)
+    batcher.stop()
+    assert results == [False, False, True, False]
+
+
+def test_send_message_reaches_lan_and_api_recipients(monkeypatch):
+    app = api.MessagingApp.__new__(api.MessagingApp)
+    app.username = "alice"
+    app.known_users = {"bob": "10.0.0.2"}
+    sent = []
+    app.send_api_group = lambda recipients, message: sent.append((recipients, message))
+
+    class Entry:
+        def get(self):
+            return "hi"
+
+        def delete(self, first, last):
+            pass
+
+    app.entry = Entry()
+    monkeypatch.setattr(api.simpledialog, "askstring", lambda *args, **kwargs: "bob, carol")
+    app.send_message()
+    assert sent == [(["bob", "carol"], "hi")]
@@ -0,0 +1,103 @@
+import asyncio
+import os
+import random
+import threading
+
+from conftest import load_script
+
+updater = load_script("client_update.py")
+
+
+def make_release(tmp_path, old):
+    # A new release that shares most of its content with the old one
+    rng = random.Random(1)
+    new = bytearray(old)
+    new[100000:100010] = rng.randbytes(10)
+    new[400000:400000] = rng.randbytes(3000)
+    del new[700000:702000]
+    updates = tmp_path / "updates"
+    updates.mkdir()
+    (updates / "client_run.py").write_bytes(bytes(new))
+    return bytes(new), updater.make_manifest(str(updates / "client_run.py"))
+
+
+def test_apply_delta_fetches_only_changes(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    old = random.Random(0).randbytes(1024 * 1024)
+    new, manifest = make_release(tmp_path, old)
+    local = tmp_path / "client_run.py"
+    local.write_bytes(old)
+    fetched = updater.apply_delta(manifest, f"{stub_server}/updates/client_run.py", str(local))
+    assert local.read_bytes() == new
+    assert 0 < fetched < len(new) // 4
+    assert not list(tmp_path.glob("*.download"))
+
+
+def test_apply_delta_rejects_bad_result(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    old = random.Random(0).randbytes(256 * 1024)
+    new, manifest = make_release(tmp_path, old)
+    manifest["sha256"] = "0" * 64
+    local = tmp_path / "client_run.py"
+    local.write_bytes(old)
+    assert updater.apply_delta(manifest, f"{stub_server}/updates/client_run.py", str(local)) is None
+    assert local.read_bytes() == old
+    assert not list(tmp_path.glob("*.download"))
+
+
+def test_content_defined_chunks_cover_data():
+    data = random.Random(2).randbytes(300000)
+    chunks = updater.content_defined_chunks(data)
+    assert chunks[0][0] == 0
+    assert all(a[0] + a[1] == b[0] for a, b in zip(chunks, chunks[1:]))
+    assert sum(size for _, size in chunks) == len(data)
+    assert all(size <= updater.CDC_MAX_SIZE for _, size in chunks)
+
+
+def test_fetch_file_verifies_what_was_written(stub_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "updates").mkdir()
+    (tmp_path / "updates" / "client_run.py").write_bytes(b"new client")
+    local = tmp_path / "client_run.py"
+    local.write_bytes(b"old client")
+    url = f"{stub_server}/updates/client_run.py"
+    assert not updater.fetch_file(url, "0" * 40, str(local))
+    assert local.read_bytes() == b"old client"
+    assert updater.fetch_file(url, updater.calculate_blob_sha(str(tmp_path / "updates" / "client_run.py")), str(local))
+    assert local.read_bytes() == b"new client"
+    assert not list(tmp_path.glob("*.download"))
+
+
+class GUI:
+    def __init__(self):
+        self.calls = []
+
+    def update_status(self, status):
+        pass
+
+    def show_error(self, error):
+        pass
+
+    def call(self, func):
+        self.calls.append(func)
+
+
+def test_timed_out_check_is_not_overlapped(monkeypatch):
+    release = threading.Event()
+    overlapped = []
+
+    async def check_and_install(gui):
+        if not release.is_set():
+            threading.Timer(0.3, release.set).start()
+            await updater.run_worker(release.wait)  # Outlives the timeout below
+            return "installed"
+        overlapped.append(bool(updater.running))
+        return "current"
+
+    monkeypatch.setattr(updater, "check_and_install", check_and_install)
+    monkeypatch.setattr(updater, "UPDATE_CHECK_TIMEOUT", 0.05)
+    monkeypatch.setattr(updater, "UPDATE_INTERVAL", 0)
+    gui = GUI()
+    asyncio.run(updater.update_loop(gui))
+    assert overlapped == [False]
+    assert gui.calls == [updater.restart_client]
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from conftest import load_script
+
+client = load_script("client_run.py")
+
+CHUNK = client.FILE_CHUNK_SIZE
+
+
+def make_offer(data, **fields):
+    chunks = [data[i:i + CHUNK] for i in range(0, len(data), CHUNK)]
+    offer = {"id": "1", "text": "", "file_offer": os.urandom(16).hex(), "name": "notes.txt", "size": len(data),
+             "chunk_size": CHUNK, "hashes": [hashlib.sha256(chunk).hexdigest() for chunk in chunks]}
+    offer.update(fields)
+    return offer
+
+
+def test_transfer_ids_must_be_hex():
+    assert client.is_transfer_id(os.urandom(16).hex())
+    for bad in ("../victim/data", "/etc/passwd", "A" * 32, "0" * 31, None, 5):
+        assert not client.is_transfer_id(bad)
+
+
+def test_file_chunk_header_is_authenticated():
+    cipher = client.SessionCipher(client.generate_aes_key())
+    transfer_id = os.urandom(16).hex()
+    frame = cipher.seal_bytes(os.urandom(client.NONCE_SIZE), client.pack_file_header("alice", transfer_id, 7), b"data")
+    sender, parsed_id, index, header, nonce, ciphertext = client.unpack_file_frame(frame)
+    assert (sender, parsed_id, index) == ("alice", transfer_id, 7)
+    forged = client.pack_file_header("alice", transfer_id, 8)
+    with pytest.raises(InvalidTag):
+        cipher.open_bytes(forged, nonce, ciphertext)
+
+
+def test_file_offer_validation():
+    data = os.urandom(CHUNK + 10)
+    assert client.is_file_offer(make_offer(data))
+    assert client.is_file_offer(make_offer(b""))
+    for fields in ({"name": None}, {"name": ["a"]}, {"size": "10"}, {"size": True}, {"size": -1},
+                   {"size": client.MAX_FILE_SIZE + 1}, {"chunk_size": 1}, {"chunk_size": "262144"},
+                   {"file_offer": "../x"}, {"hashes": None}, {"hashes": ["0" * 64]}, {"hashes": ["zz" * 32] * 2}):
+        assert not client.is_file_offer(make_offer(data, **fields)), fields
+
+
+def test_chunks_must_match_offer(tmp_path):
+    data = os.urandom(2 * CHUNK + 100)
+    offer = make_offer(data)
+    download = client.IncomingFile(offer["file_offer"], "alice", offer["name"], offer["size"], CHUNK,
+                                   offer["hashes"], str(tmp_path))
+    with pytest.raises(ValueError):
+        download.write(0, os.urandom(CHUNK))
+    assert not download.write(0, data[:CHUNK])
+    download.close()
+
+    # Resumes from the progress file, knowing what the offer said
+    [download] = client.IncomingFile.load_all(str(tmp_path))
+    assert download.remaining == 2 and download.expected == offer["hashes"]
+    assert not download.write(2, data[2 * CHUNK:])
+    assert download.write(1, data[CHUNK:2 * CHUNK])
+    path = download.finish()
+    with open(path, "rb") as f:
+        assert f.read() == data
+
+
+def test_changed_files_are_not_offered_again(tmp_path):
+    kept, edited = tmp_path / "kept.bin", tmp_path / "edited.bin"
+    kept.write_bytes(b"a" * 100)
+    edited.write_bytes(b"b" * 100)
+    outgoing = {transfer_id: [str(path), "bob"] + client.file_version(str(path)) + [client.deque(), None]
+                for transfer_id, path in (("1" * 32, kept), ("2" * 32, edited))}
+    state = str(tmp_path / "outgoing.json")
+    client.save_outgoing_files(outgoing, state)
+    edited.write_bytes(b"c" * 100)  # Same size, new contents
+    os.utime(edited, ns=(0, 0))
+    assert list(client.load_outgoing_files(state)) == ["1" * 32]
+    with open(state) as f:
+        assert json.load(f)["1" * 32] == [str(kept), "bob", 100, kept.stat().st_mtime_ns]
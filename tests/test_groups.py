@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+
+import pytest
+
+from conftest import load_script
+
+client = load_script("client_run.py")
+
+
+class Outbox:
+    def __init__(self):
+        self.queued = []  # (recipient, body)
+        self.dropped = []
+
+    def enqueue(self, recipient, text, **fields):
+        message_id = os.urandom(8).hex()
+        self.queued.append((recipient, {"id": message_id, "text": text, **fields}))
+        return message_id
+
+    def acknowledge(self, recipient, message_id, delivered=True):
+        self.dropped.append((recipient, message_id))
+
+
+class Transport:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, payload, addr):
+        self.sent.append(payload)
+
+
+# A client with just enough state to send and receive group traffic, without a window or sockets
+def make_app(tmp_path, username):
+    app = client.MessagingApp.__new__(client.MessagingApp)
+    app.username = username
+    app.groups = client.GroupDirectory(str(tmp_path / f"{username}.db"))
+    app.outbox = Outbox()
+    app.lan_transport = Transport()
+    app.known_users = client.PeerDirectory()
+    for name in ("alice", "bob", "carol", "dave"):
+        app.known_users.seen(name, f"10.0.0.{len(name)}")
+    app.peer_events = []
+    app.recent_ids = {}
+    app.recent_ids_lock = threading.Lock()
+    app.requests = []
+    app.send_secure = lambda recipient, message, ip=None: app.requests.append((recipient, json.loads(message)))
+    return app
+
+
+@pytest.fixture
+def apps(tmp_path):
+    apps = {name: make_app(tmp_path, name) for name in ("alice", "bob", "carol", "dave")}
+    yield apps
+    for app in apps.values():
+        app.groups.close()
+
+
+# Hand every queued pairwise group message to its recipient, until none are left
+def deliver(apps):
+    while any(app.outbox.queued for app in apps.values()):
+        for sender, app in apps.items():
+            queued, app.outbox.queued = app.outbox.queued, []
+            for recipient, body in queued:
+                apps[recipient].handle_group_update(sender, body)
+
+
+# Send a group message from sender and return who could read it
+def readers(apps, sender, group):
+    app = apps[sender]
+    payload = json.dumps({"id": os.urandom(8).hex(), "text": "hi", "to_group": group})
+    read = []
+    for member in app.groups.members(group):
+        if member == sender:
+            continue
+        app.send_queued(member, payload)
+        if apps[member].handle_group_frame(app.lan_transport.sent.pop(), (app.known_users[sender], 5555)):
+            read.append(member)
+    return read
+
+
+def create_group(app, group, members, monkeypatch):
+    answers = iter([group, ", ".join(members)])
+    monkeypatch.setattr(client.simpledialog, "askstring", lambda *args, **kwargs: next(answers))
+    app.add_message = lambda message: None
+    app.create_group()
+
+
+def test_members_learn_group_and_keys(apps, monkeypatch):
+    create_group(apps["alice"], "team", ["bob", "carol"], monkeypatch)
+    deliver(apps)
+    assert apps["bob"].groups.members("team") == ["alice", "bob", "carol"]
+    assert apps["bob"].groups.owner("team") == "alice"
+    assert readers(apps, "alice", "team") == ["bob", "carol"]
+    readers(apps, "bob", "team")  # Bob's first message hands out his key, and can't be read until it arrives
+    deliver(apps)
+    assert readers(apps, "bob", "team") == ["alice", "carol"]
+
+
+def test_only_owner_changes_members(apps, monkeypatch):
+    create_group(apps["alice"], "team", ["bob", "carol"], monkeypatch)
+    deliver(apps)
+    key = client.base64.b64encode(client.generate_aes_key()).decode()
+    apps["carol"].handle_group_update("bob", {"group": "team", "members": ["bob", "carol", "dave"], "key": key})
+    apps["carol"].handle_group_update("dave", {"group": "team", "members": ["alice", "bob", "carol", "dave"], "key": key})
+    assert apps["carol"].groups.members("team") == ["alice", "bob", "carol"]
+    assert apps["carol"].groups.sender_key("team", "dave") is None
+
+
+def test_adding_member_reaches_everyone(apps, monkeypatch):
+    create_group(apps["alice"], "team", ["bob", "carol"], monkeypatch)
+    deliver(apps)
+    readers(apps, "bob", "team")
+    deliver(apps)
+    create_group(apps["alice"], "team", ["bob", "carol", "dave"], monkeypatch)
+    deliver(apps)
+    assert apps["carol"].groups.members("team") == ["alice", "bob", "carol", "dave"]
+    assert readers(apps, "bob", "team") == ["alice", "carol", "dave"]  # Bob rotated and gave Dave his key
+    readers(apps, "dave", "team")
+    deliver(apps)
+    assert readers(apps, "dave", "team") == ["alice", "bob", "carol"]
+
+
+def test_removed_member_reads_nothing_further(apps, monkeypatch):
+    create_group(apps["alice"], "team", ["bob", "carol", "dave"], monkeypatch)
+    deliver(apps)
+    for sender in ("bob", "carol"):
+        readers(apps, sender, "team")
+        deliver(apps)
+    old_bob_key = apps["bob"].groups.current_key("team")
+    create_group(apps["alice"], "team", ["bob", "carol"], monkeypatch)
+    deliver(apps)
+    assert "team" not in apps["dave"].groups
+    assert apps["bob"].groups.current_key("team") is not old_bob_key
+    assert "dave" not in apps["bob"].groups.members("team")
+    # Dave still holds Bob's old key, but Bob's next message is under the new one
+    payload = json.dumps({"id": "m1", "text": "secret", "to_group": "team"})
+    apps["bob"].send_queued("carol", payload)
+    frame = apps["bob"].lan_transport.sent.pop()
+    _, _, header, nonce, ciphertext = client.unpack_group_frame(frame)
+    with pytest.raises(client.InvalidTag):
+        old_bob_key.open(header, nonce, ciphertext)
+    apps["bob"].send_queued("dave", payload)  # Queued for Dave before he was removed
+    assert apps["bob"].outbox.dropped == [("dave", "m1")]
+
+
+def test_owner_survives_reopening(tmp_path):
+    groups = client.GroupDirectory(str(tmp_path / "history.db"))
+    groups.set_members("team", ["alice", "bob"], owner="alice")
+    groups.close()
+    groups = client.GroupDirectory(str(tmp_path / "history.db"))
+    assert groups.owner("team") == "alice" and groups.members("team") == ["alice", "bob"]
+    groups.close()
@@ -0,0 +1,71 @@
+from conftest import load_script
+
+client = load_script("client_run.py")
+
+
+def make_history(tmp_path, count):
+    history = client.MessageHistory(str(tmp_path / "history.db"))
+    history.append_many([("bob", "bob", f"message {i}") for i in range(count)])
+    return history
+
+
+def test_latest_page_is_oldest_first(tmp_path):
+    history = make_history(tmp_path, 25)
+    page = history.page(limit=10)
+    assert [row[4] for row in page] == [f"message {i}" for i in range(15, 25)]
+    history.close()
+
+
+def test_pages_walk_back_to_the_start(tmp_path):
+    history = make_history(tmp_path, 25)
+    bodies = []
+    page = history.page(limit=10)
+    while page:
+        bodies[:0] = [row[4] for row in page]
+        page = history.page(before_id=page[0][0], limit=10)
+    assert bodies == [f"message {i}" for i in range(25)]
+    history.close()
+
+
+def test_history_survives_reopening(tmp_path):
+    make_history(tmp_path, 3).close()
+    history = client.MessageHistory(str(tmp_path / "history.db"))
+    assert [row[4] for row in history.page()] == ["message 0", "message 1", "message 2"]
+    history.close()
+
+
+def test_search_matches_words_and_prefixes(tmp_path):
+    history = client.MessageHistory(str(tmp_path / "history.db"))
+    history.append_many([("bob", "bob", "lunch at noon?"), ("carol", "carol", "the meeting moved"),
+                         ("bob", "alice", "meetings are long")])
+    assert {row[4] for row in history.search("meeting")} == {"the meeting moved", "meetings are long"}
+    assert [row[4] for row in history.search("lunch noon")] == ["lunch at noon?"]
+    assert history.search("dinner") == []
+    assert history.search("   ") == []
+    history.close()
+
+
+def test_search_treats_input_as_text(tmp_path):
+    history = client.MessageHistory(str(tmp_path / "history.db"))
+    history.append_many([("bob", "bob", 'she said "NEAR" OR not')])
+    assert len(history.search('"NEAR" OR')) == 1
+    assert history.search("AND (") == []
+    history.close()
+
+
+def test_search_indexes_existing_history(tmp_path):
+    history = make_history(tmp_path, 5)
+    history.db.execute("DROP TABLE messages_fts")
+    history.db.commit()
+    history.close()
+    history = client.MessageHistory(str(tmp_path / "history.db"))
+    assert [row[4] for row in history.search("message")] != []
+    history.close()
+
+
+def test_search_context_stays_in_conversation(tmp_path):
+    history = client.MessageHistory(str(tmp_path / "history.db"))
+    rows = history.append_many([("bob", "bob", f"b{i}") if i % 2 else ("carol", "carol", f"c{i}") for i in range(10)])
+    hit = rows[5][0]  # b5
+    assert [row[4] for row in history.context(hit, radius=1)] == ["b3", "b5", "b7"]
+    history.close()
@@ -0,0 +1,31 @@
+import os
+
+from conftest import load_script
+
+client = load_script("client_run.py")
+
+
+def test_unencrypted_key_is_private(tmp_path):
+    path = str(tmp_path / "identity_key.pem")
+    store = client.IdentityKeyStore(None, "ed25519", path, path + ".pub")
+    store.load()
+    assert store.get()[0] is not None and store.error is None
+    if os.name != "nt":
+        assert os.stat(path).st_mode & 0o777 == 0o600
+    reloaded = client.IdentityKeyStore(None, "ed25519", path, path + ".pub")
+    reloaded.load()
+    assert reloaded.get()[1].public_bytes_raw() == store.get()[1].public_bytes_raw()
+
+
+def test_wrong_passphrase_leaves_key_untouched(tmp_path):
+    path = str(tmp_path / "identity_key.pem")
+    client.IdentityKeyStore(b"right", "ed25519", path, path + ".pub").load()
+    with open(path, "rb") as f:
+        saved = f.read()
+    for passphrase in (b"wrong", None):
+        store = client.IdentityKeyStore(passphrase, "ed25519", path, path + ".pub")
+        store.load()
+        assert store.get() == (None, None)
+        assert client.KEYSTORE_PASSPHRASE_ENV in store.error
+    with open(path, "rb") as f:
+        assert f.read() == saved
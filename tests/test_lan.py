@@ -0,0 +1,103 @@
+import json
+import os
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from conftest import load_script
+
+client = load_script("client_run.py")
+
+
+def test_session_cipher_round_trip():
+    cipher = client.SessionCipher(client.generate_aes_key())
+    message = json.dumps({"id": "1", "text": "hello"})
+    frame = cipher.encrypt("alice", message)
+    assert client.unpack_frame(frame)[0] == "alice"
+    assert cipher.decrypt(frame) == message
+
+
+@pytest.mark.parametrize("position", [1, 3, 10, -1])
+def test_session_cipher_rejects_tampered_frame(position):
+    cipher = client.SessionCipher(client.generate_aes_key())
+    frame = bytearray(cipher.encrypt("alice", json.dumps({"id": "1", "text": "hello"})))
+    frame[position] ^= 1
+    with pytest.raises((InvalidTag, ValueError)):
+        cipher.decrypt(bytes(frame))
+
+
+def test_session_cipher_rejects_other_key():
+    frame = client.SessionCipher(client.generate_aes_key()).encrypt("alice", "{}")
+    with pytest.raises(InvalidTag):
+        client.SessionCipher(client.generate_aes_key()).decrypt(frame)
+
+
+def test_compressed_message_round_trip():
+    cipher = client.SessionCipher(client.generate_aes_key())
+    message = json.dumps({"id": "1", "text": "hello there " * 50})
+    frame = cipher.encrypt("alice", message, compress=True)
+    assert len(frame) < len(message)
+    assert cipher.decrypt(frame) == message
+
+
+def test_decompression_bomb_is_refused():
+    compressor = client.zlib.compressobj(9, client.zlib.DEFLATED, -15, zdict=client.CHAT_DICTIONARY)
+    bomb = client.COMPRESSED_MARKER + compressor.compress(bytes(client.MAX_FRAME_SIZE + 1)) + compressor.flush()
+    with pytest.raises(ValueError):
+        client.decompress_payload(bomb)
+
+
+@pytest.mark.parametrize("key_type", ["rsa", "ed25519"])
+def test_handshake_signature_covers_transcript(key_type):
+    identity = client.generate_identity_key(key_type)
+    ephemeral = os.urandom(32)
+    signature = client.sign_with_identity(identity, client.handshake_transcript("alice", "bob", ephemeral, False))
+    client.verify_identity_signature(identity.public_key(), signature,
+                                     client.handshake_transcript("alice", "bob", ephemeral, False))
+    with pytest.raises(client.InvalidSignature):
+        client.verify_identity_signature(identity.public_key(), signature,
+                                         client.handshake_transcript("alice", "carol", ephemeral, False))
+
+
+def test_handshake_waits_for_identity_key_without_blocking(tmp_path):
+    class Transport:
+        sent = []
+
+        def send(self, payload, addr):
+            self.sent.append((json.loads(payload), addr))
+
+    app = client.MessagingApp.__new__(client.MessagingApp)
+    app.username = "alice"
+    app.lan_transport = Transport()
+    path = str(tmp_path / "identity_key.pem")
+    app.keystore = client.IdentityKeyStore(None, "ed25519", path, path + ".pub")
+    ephemeral = client.x25519.X25519PrivateKey.generate()
+    app.send_handshake("bob", "10.0.0.2", ephemeral, reply=False)
+    assert app.lan_transport.sent == []
+    app.keystore.load()
+    (hello, addr), = app.lan_transport.sent
+    assert addr == ("10.0.0.2", client.BROADCAST_PORT)
+    assert (hello["from"], hello["to"], hello["reply"]) == ("alice", "bob", False)
+
+
+def test_receive_pump_survives_errors():
+    class Root:
+        scheduled = []
+
+        def after(self, delay, callback):
+            self.scheduled.append(callback)
+
+    app = client.MessagingApp.__new__(client.MessagingApp)
+    app.root = Root()
+    app.peer_events = client.deque()
+    app.file_offers = client.deque()
+    app.received = client.deque()
+    with client.ThreadPoolExecutor(1) as pool:
+        app.received.append(pool.submit(lambda: ("bob", "bob", "hi")))
+
+    def record_messages(entries):
+        raise client.sqlite3.OperationalError("database is locked")
+
+    app.record_messages = record_messages
+    app.pump_received()
+    assert app.root.scheduled == [app.pump_received]
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from conftest import load_script
+
+client = load_script("client_run.py")
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def make_outbox(loop, path, peers, sent, delivered=None):
+    delivered = [] if delivered is None else delivered
+    outbox = client.Outbox(loop, peers, lambda recipient, payload: sent.append((recipient, json.loads(payload))),
+                           path=path, on_delivered=lambda recipient, message_id: delivered.append(message_id))
+    outbox.start()
+    return outbox
+
+
+def test_ack_removes_and_reports_delivery(loop, tmp_path):
+    peers = client.PeerDirectory()
+    peers.seen("bob", "10.0.0.2")
+    sent, delivered = [], []
+    outbox = make_outbox(loop, str(tmp_path / "history.db"), peers, sent, delivered)
+    message_id = outbox.enqueue("bob", "hi")
+    wait_for(lambda: sent)
+    assert sent[0] == ("bob", {"id": message_id, "text": "hi"})
+    outbox.acknowledge("bob", message_id)
+    wait_for(lambda: delivered)
+    assert delivered == [message_id]
+    outbox.stop()
+
+
+def test_unacknowledged_message_is_retried(loop, tmp_path, monkeypatch):
+    monkeypatch.setattr(client, "RETRY_INITIAL", 0.1)
+    peers = client.PeerDirectory()
+    peers.seen("bob", "10.0.0.2")
+    sent = []
+    outbox = make_outbox(loop, str(tmp_path / "history.db"), peers, sent)
+    outbox.enqueue("bob", "hi")
+    wait_for(lambda: len(sent) >= 3)
+    assert {payload["text"] for _, payload in sent} == {"hi"}
+    outbox.stop()
+
+
+def test_window_limits_messages_in_flight(loop, tmp_path):
+    peers = client.PeerDirectory()
+    peers.seen("bob", "10.0.0.2")
+    sent = []
+    outbox = make_outbox(loop, str(tmp_path / "history.db"), peers, sent)
+    ids = [outbox.enqueue("bob", str(i)) for i in range(client.OUTBOX_WINDOW + 3)]
+    wait_for(lambda: len(sent) >= client.OUTBOX_WINDOW)
+    time.sleep(0.1)
+    assert [payload["text"] for _, payload in sent] == [str(i) for i in range(client.OUTBOX_WINDOW)]
+    outbox.acknowledge("bob", ids[0])
+    wait_for(lambda: len(sent) > client.OUTBOX_WINDOW)
+    assert sent[client.OUTBOX_WINDOW][1]["text"] == str(client.OUTBOX_WINDOW)
+    outbox.stop()
+
+
+def test_queue_survives_restart_and_waits_for_recipient(loop, tmp_path):
+    path = str(tmp_path / "history.db")
+    peers = client.PeerDirectory()
+    sent = []
+    outbox = make_outbox(loop, path, peers, sent)
+    delivered_id = outbox.enqueue("bob", "first")
+    outbox.enqueue("bob", "second")
+    outbox.acknowledge("bob", delivered_id)
+    outbox.stop()
+    time.sleep(0.1)
+    assert sent == []  # Bob was never online
+
+    peers.seen("bob", "10.0.0.2")
+    restarted = make_outbox(loop, path, peers, sent)
+    wait_for(lambda: sent)
+    assert [payload["text"] for _, payload in sent] == ["second"]
+    restarted.stop()
@@ -0,0 +1,61 @@
+from conftest import load_script
+
+client = load_script("client_run.py")
+
+
+def test_peer_directory_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(client.time, "monotonic", lambda: now[0])
+    events = []
+    peers = client.PeerDirectory(ttl=30, on_change=lambda event, username, address: events.append((event, username)))
+
+    def run(seconds):
+        for _ in range(seconds):
+            now[0] += 1
+            peers.tick()
+
+    peers.seen("alice", "10.0.0.1", ["zlib"])
+    peers.seen("bob", "10.0.0.2")
+    run(20)
+    peers.seen("alice", "10.0.0.1", ["zlib"])  # Only alice keeps beaconing
+    run(20)
+    assert "alice" in peers and "bob" not in peers
+    assert peers["alice"] == "10.0.0.1"
+    assert "zlib" in peers.capabilities("alice")
+    assert events == [("join", "alice"), ("join", "bob"), ("leave", "bob")]
+    run(30)
+    assert "alice" not in peers
+
+
+def test_peer_address_change_is_reported(monkeypatch):
+    events = []
+    peers = client.PeerDirectory(ttl=30, on_change=lambda event, username, address: events.append((event, address)))
+    peers.seen("alice", "10.0.0.1")
+    peers.seen("alice", "10.0.0.1")
+    peers.seen("alice", "10.0.0.7")
+    peers.remove("alice")
+    assert events == [("join", "10.0.0.1"), ("update", "10.0.0.7"), ("leave", "10.0.0.7")]
+
+
+def test_beacon_backoff_ignores_peer_churn(monkeypatch):
+    transport = client.LanTransport("alice", client.PeerDirectory())
+    sent, delays = [], []
+    transport.send = lambda payload, addr: sent.append(client.json.loads(payload))
+    addresses = iter(["10.0.0.1"] * 6 + ["10.0.0.9"] * 3)
+    monkeypatch.setattr(client, "get_local_ip", lambda: next(addresses))
+    monkeypatch.setattr(client, "BEACON_JITTER", 0)
+
+    async def sleep(delay):
+        delays.append(delay)
+        transport.known_users.seen(f"peer{len(delays)}", "10.0.0.2")  # Someone joins every round
+        if len(delays) == 8:
+            raise client.asyncio.CancelledError()
+
+    monkeypatch.setattr(client.asyncio, "sleep", sleep)
+    try:
+        client.asyncio.run(transport.beacon_loop())
+    except client.asyncio.CancelledError:
+        pass
+    transport.loop.close()
+    assert delays == [2, 4, 8, 16, 32, 60, 2, 4]
+    assert [beacon.get("query", False) for beacon in sent] == [True, False, False, False, False, False, True, False]
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+
+import pytest
+
+from conftest import load_script
+
+client = load_script("client_run.py")
+updater = load_script("client_update.py")
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    path = tmp_path / "update_cache"
+    monkeypatch.setattr(updater, "UPDATE_CACHE_DIR", str(path))
+    monkeypatch.setattr(updater, "UPDATE_FROM_PEERS", False)
+    return path
+
+
+def test_cache_keeps_newest_files(cache_dir, tmp_path):
+    keys = []
+    for n in range(updater.UPDATE_CACHE_FILES + 2):
+        source = tmp_path / f"release{n}"
+        source.write_bytes(b"release %d" % n)
+        key = updater.calculate_hash(str(source))
+        updater.store_in_cache(str(source), key)
+        os.utime(updater.cache_path(key), (n, n))
+        keys.append(key)
+    assert sorted(os.listdir(cache_dir)) == sorted(keys[-updater.UPDATE_CACHE_FILES:])
+
+
+def test_fetch_cached_verifies_cached_file(cache_dir, tmp_path):
+    source = tmp_path / "release"
+    source.write_bytes(b"new client")
+    key = updater.calculate_hash(str(source))
+    updater.store_in_cache(str(source), key)
+    target = tmp_path / "client_run.py"
+    target.write_bytes(b"old client")
+
+    (cache_dir / key).write_bytes(b"tampered!!")
+    assert not updater.fetch_cached(key, 10, str(target))
+    assert target.read_bytes() == b"old client"
+
+    (cache_dir / key).write_bytes(b"new client")
+    assert updater.fetch_cached(key, 10, str(target))
+    assert target.read_bytes() == b"new client"
+
+
+# A client serving an update: reads the request, sends a header claiming size, then the frames given
+def serve_once(size, frames):
+    server = socket.create_server(("127.0.0.1", 0))
+
+    def run():
+        conn, _ = server.accept()
+        with conn, server:
+            updater.read_frame(conn)
+            try:
+                for payload in [json.dumps({"update_offer": "k", "size": size}).encode()] + frames:
+                    conn.sendall(client.FRAME_HEADER.pack(len(payload)) + payload)
+                conn.recv(1)
+            except OSError:
+                pass  # The updater hung up on us
+
+    threading.Thread(target=run, daemon=True).start()
+    return server.getsockname()[1]
+
+
+@pytest.mark.parametrize("frames", [[b"abc", b"def"], [b"abc", b"def", b"XXX"]])
+def test_peer_download_stops_at_expected_size(tmp_path, monkeypatch, frames):
+    monkeypatch.setattr(updater, "LAN_PORT", serve_once(6, frames))
+    target = tmp_path / "download"
+    assert updater.download_from_peer("127.0.0.1", "k", 6, str(target))
+    assert target.read_bytes() == b"abcdef"
+
+
+@pytest.mark.parametrize("claimed, frames", [(4, [b"abcd"]), (1 << 40, [b"abc"]), (6, [b"abc", b"defXXXXXX"])])
+def test_peer_download_rejects_wrong_size(tmp_path, monkeypatch, claimed, frames):
+    monkeypatch.setattr(updater, "LAN_PORT", serve_once(claimed, frames))
+    target = tmp_path / "download"
+    with pytest.raises(ValueError):
+        updater.download_from_peer("127.0.0.1", "k", 6, str(target))
+    assert not target.exists() or target.stat().st_size <= 6
+
+
+@pytest.fixture
+def transport():
+    transport = client.LanTransport("alice", client.PeerDirectory())
+    yield transport
+    transport.loop.close()
+
+
+class Connection:
+    def __init__(self, peer, outbound=False):
+        self.peer = peer
+        self.outbound = outbound
+        self.frames = []
+
+    def write_frame(self, payload):
+        self.frames.append(payload)
+
+    async def drain(self):
+        pass
+
+
+def test_inbound_connections_are_not_pooled(transport):
+    updater_conn = Connection(("10.0.0.2", 40000))
+    chat_conn = Connection(("10.0.0.2", client.BROADCAST_PORT), outbound=True)
+    transport.add_stream(updater_conn)
+    assert "10.0.0.2" not in transport.streams
+    transport.add_stream(chat_conn)
+    assert transport.streams["10.0.0.2"] is chat_conn
+    assert transport.connections[("10.0.0.2", 40000)] is updater_conn
+    transport.remove_stream(updater_conn)
+    assert transport.streams["10.0.0.2"] is chat_conn and ("10.0.0.2", 40000) not in transport.connections
+
+
+def test_replies_to_other_ports_go_by_udp(transport):
+    transport.streams["10.0.0.2"] = Connection(("10.0.0.2", client.BROADCAST_PORT), outbound=True)
+    transport.send(b'{"update_offer": "k"}', ("10.0.0.2", 40000))
+    assert list(transport.send_queue) == [(b'{"update_offer": "k"}', ("10.0.0.2", 40000))]
+
+
+def test_update_is_served_on_the_requesting_connection(transport, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = os.urandom(client.FILE_CHUNK_SIZE + 5)
+    key = hashlib.sha256(data).hexdigest()
+    os.makedirs(client.UPDATE_CACHE_DIR)
+    (tmp_path / client.UPDATE_CACHE_DIR / key).write_bytes(data)
+    chat_conn = Connection(("10.0.0.2", client.BROADCAST_PORT), outbound=True)
+    updater_conn = Connection(("10.0.0.2", 40000))
+    transport.add_stream(chat_conn)
+    transport.add_stream(updater_conn)
+    app = client.MessagingApp.__new__(client.MessagingApp)
+    app.lan_transport = transport
+    transport.loop.run_until_complete(app.serve_update(key, ("10.0.0.2", 40000)))
+    assert chat_conn.frames == []
+    assert json.loads(updater_conn.frames[0]) == {"update_offer": key, "size": len(data)}
+    assert b"".join(updater_conn.frames[1:]) == data